@@ -0,0 +1,212 @@
+"""
+SFTP upload throughput of the DMF transfer path over a high-latency link.
+
+Runs an in-process paramiko SFTP server behind a TCP proxy that delays every
+segment by half the round-trip time, then uploads the same files twice:
+
+  before: one SSH transport per worker, paramiko defaults and putfo
+          (the write path dmf_filetransfer used before tuning)
+  after:  dmf_filetransfer's SftpConnectionPool and put_stream with the
+          SFTP_* window, packet and request-size settings
+
+    python benchmarks/sftp_throughput.py --rtt-ms 80 --files 16 --size-mb 8 --workers 4
+"""
+import argparse
+import io
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+
+# dmf_filetransfer reads these at import time
+for name in ("DB_SECRET_NAME", "S3_BUCKET", "DB_SCHEMA", "DB_TABLE", "META_TABLE", "CONFIG_TABLE", "TRANSFER_LIMIT"):
+    os.environ.setdefault(name, "benchmark")
+os.environ.setdefault("MAX_THREADS", "8")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dmf_filetransfer  # noqa: E402
+
+USERNAME = "bench"
+PASSWORD = "bench"
+
+
+# --- In-process SFTP server ---
+class StubServer(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL if (username, password) == (USERNAME, PASSWORD) else paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class LocalHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.writefile.fileno()))
+
+
+class LocalSFTP(paramiko.SFTPServerInterface):
+    """Serves a single directory; enough for open/write/stat/close."""
+
+    root = None
+
+    def _path(self, path):
+        return os.path.join(self.root, os.path.basename(path))
+
+    def open(self, path, flags, attr):
+        handle = LocalHandle(flags)
+        handle.writefile = handle.readfile = open(self._path(path), "w+b")
+        return handle
+
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+
+    lstat = stat
+
+
+def serve_sftp(root, host_key):
+    LocalSFTP.root = root
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(64)
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, LocalSFTP)
+            transport.start_server(server=StubServer())
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+# --- Latency-injecting proxy ---
+def pipe(src, dst, delay):
+    """Forwards src to dst, delivering each segment `delay` seconds after it arrived."""
+    backlog = []
+    ready = threading.Condition()
+
+    def reader():
+        while True:
+            try:
+                data = src.recv(256 * 1024)
+            except OSError:
+                data = b""
+            with ready:
+                backlog.append((time.monotonic() + delay, data))
+                ready.notify()
+            if not data:
+                return
+
+    def writer():
+        while True:
+            with ready:
+                while not backlog:
+                    ready.wait()
+                due, data = backlog.pop(0)
+            time.sleep(max(0.0, due - time.monotonic()))
+            try:
+                if not data:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+            except OSError:
+                # The other side already closed; teardown at the end of a run
+                return
+
+    threading.Thread(target=reader, daemon=True).start()
+    threading.Thread(target=writer, daemon=True).start()
+
+
+def serve_proxy(target_port, rtt):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(64)
+
+    def accept():
+        while True:
+            client, _ = listener.accept()
+            upstream = socket.create_connection(("127.0.0.1", target_port))
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            pipe(client, upstream, rtt / 2)
+            pipe(upstream, client, rtt / 2)
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+# --- Upload modes ---
+def upload_before(port, payloads, workers):
+    def worker(names):
+        transport = paramiko.Transport(("127.0.0.1", port))
+        transport.connect(username=USERNAME, password=PASSWORD)
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        try:
+            for name in names:
+                sftp.putfo(io.BytesIO(payloads[name]), name)
+        finally:
+            sftp.close()
+            transport.close()
+
+    names = sorted(payloads)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(worker, [names[i::workers] for i in range(workers)]))
+
+
+def upload_after(port, payloads, workers):
+    dmf_filetransfer.get_sftp_credentials = lambda: {
+        "host": "127.0.0.1", "port": port, "username": USERNAME, "password": PASSWORD
+    }
+    pool = dmf_filetransfer.SftpConnectionPool(dmf_filetransfer.SFTP_CHANNELS_PER_CONNECTION)
+    chunk = dmf_filetransfer.S3_READ_CHUNK_SIZE
+
+    def worker(names):
+        sftp = pool.acquire()
+        try:
+            for name in names:
+                data = payloads[name]
+                dmf_filetransfer.put_stream(sftp, (data[i:i + chunk] for i in range(0, len(data), chunk)), name)
+        finally:
+            pool.release(sftp)
+
+    names = sorted(payloads)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(worker, [names[i::workers] for i in range(workers)]))
+    finally:
+        pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rtt-ms", type=float, default=80)
+    parser.add_argument("--files", type=int, default=16)
+    parser.add_argument("--size-mb", type=float, default=8)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    payloads = {f"file_{i:04d}.bin": os.urandom(int(args.size_mb * 1024 * 1024)) for i in range(args.files)}
+    total_mb = args.files * args.size_mb
+    with tempfile.TemporaryDirectory() as root:
+        sftp_port = serve_sftp(root, paramiko.RSAKey.generate(2048))
+        proxy_port = serve_proxy(sftp_port, args.rtt_ms / 1000)
+        print(f"{args.files} x {args.size_mb} MB, {args.workers} workers, {args.rtt_ms:.0f} ms RTT")
+        for label, upload in (("before", upload_before), ("after", upload_after)):
+            started = time.perf_counter()
+            upload(proxy_port, payloads, args.workers)
+            seconds = time.perf_counter() - started
+            print(f"{label:>6}: {total_mb / seconds:8.2f} MB/s ({seconds:.1f} s)")
+
+
+if __name__ == "__main__":
+    main()
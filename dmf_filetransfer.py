@@ -6,10 +6,23 @@ import os
 import logging
 import threading
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import shutil
+import socket
+import tarfile
+import zipfile
+import base64
+import hashlib
+import io
+import itertools
+import queue
+import time
+from collections import defaultdict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from urllib.parse import urlparse
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import NamedTupleCursor
+from psycopg2.pool import ThreadedConnectionPool
 from botocore.exceptions import ClientError  # Required for S3 key check
 
 logger = logging.getLogger()
@@ -19,6 +32,33 @@ logger.setLevel(logging.INFO)
 # Environment variables
 # Number of parallel SFTP connections
 MAX_THREADS = int(os.environ.get("MAX_THREADS"))  
+# Adaptive concurrency between MIN_THREADS and MAX_THREADS
+MIN_THREADS = int(os.environ.get("MIN_THREADS", "1"))
+INITIAL_THREADS = int(os.environ.get("INITIAL_THREADS", "2"))
+CONCURRENCY_INTERVAL_SECONDS = float(os.environ.get("CONCURRENCY_INTERVAL_SECONDS", "5"))
+CONCURRENCY_MAX_ERROR_RATE = float(os.environ.get("CONCURRENCY_MAX_ERROR_RATE", "0.1"))
+CONCURRENCY_MIN_GAIN = float(os.environ.get("CONCURRENCY_MIN_GAIN", "0.05"))
+SFTP_MAX_HANDSHAKE_FAILURES = int(os.environ.get("SFTP_MAX_HANDSHAKE_FAILURES", "5"))
+# A worker slot whose handshake failed stays empty this long, doubling per consecutive failure
+SFTP_HANDSHAKE_BACKOFF_SECONDS = float(os.environ.get("SFTP_HANDSHAKE_BACKOFF_SECONDS", "2"))
+SFTP_HANDSHAKE_BACKOFF_MAX_SECONDS = float(os.environ.get("SFTP_HANDSHAKE_BACKOFF_MAX_SECONDS", "30"))
+# How often run_transfers re-evaluates its workers while they run
+SCHEDULER_TICK_SECONDS = 1.0
+# Integrity checksums computed while streaming: md5 or sha256
+CHECKSUM_ALGORITHM = os.environ.get("CHECKSUM_ALGORITHM", "md5").lower()
+CHECKSUM_MANIFEST = os.environ.get("CHECKSUM_MANIFEST", "false").lower() == "true"
+# Compare the MD5 against single-part S3 ETags (not valid for SSE-KMS objects)
+VERIFY_ETAG = os.environ.get("VERIFY_ETAG", "true").lower() == "true"
+# Rows fetched per server-side cursor round trip, and index.csv write buffer
+FETCH_BATCH_SIZE = int(os.environ.get("FETCH_BATCH_SIZE", "2000"))
+METADATA_BUFFER_SIZE = int(os.environ.get("METADATA_BUFFER_SIZE", str(256 * 1024)))
+METADATA_FILENAME = "index.csv"
+# Bundle mode: groups of files streamed into tar/zip archives
+BUNDLE_MAX_FILES = int(os.environ.get("BUNDLE_MAX_FILES", "500"))
+BUNDLE_MAX_BYTES = int(os.environ.get("BUNDLE_MAX_BYTES", str(512 * 1024 * 1024)))
+BUNDLE_MANIFEST_FILENAME = "bundles.csv"
+# CloudWatch Embedded Metric Format namespace for transfer telemetry
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "DmfFileTransfer")
 SECRET_NAME = os.environ['DB_SECRET_NAME']
 s3_bucket = os.environ['S3_BUCKET']
 # s3Prefix = os.environ['s3Prefix']
@@ -28,15 +68,207 @@ table = os.environ['DB_TABLE']
 meta_table=os.environ['META_TABLE']
 config_table=os.environ['CONFIG_TABLE']
 transfer_limit=os.environ['TRANSFER_LIMIT']
+# Connections kept open across warm invocations and shared by threads
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "2"))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "300000"))
+db_pool = None
+db_pool_lock = threading.Lock()
+# Per-file transfer checkpoints, so an interrupted run resumes instead of re-sending
+CHECKPOINT_PREFIX = os.environ.get("CHECKPOINT_PREFIX", "dmf-checkpoints/")
+CHECKPOINT_MAX_AGE_HOURS = float(os.environ.get("CHECKPOINT_MAX_AGE_HOURS", "24"))
+# On resume, stat files on the SFTP side and skip the ones already complete
+VERIFY_REMOTE_SIZE = os.environ.get("VERIFY_REMOTE_SIZE", "false").lower() == "true"
+# SFTP write path tuning
+SFTP_CHANNELS_PER_CONNECTION = int(os.environ.get("SFTP_CHANNELS_PER_CONNECTION", "4"))
+SFTP_WINDOW_SIZE = int(os.environ.get("SFTP_WINDOW_SIZE", str(16 * 1024 * 1024)))
+SFTP_MAX_PACKET_SIZE = int(os.environ.get("SFTP_MAX_PACKET_SIZE", str(256 * 1024)))
+SFTP_REQUEST_SIZE = int(os.environ.get("SFTP_REQUEST_SIZE", str(128 * 1024)))
+S3_READ_CHUNK_SIZE = int(os.environ.get("S3_READ_CHUNK_SIZE", str(1024 * 1024)))
+# Objects at least this large are read with concurrent ranged GETs
+RANGED_READ_THRESHOLD = int(os.environ.get("RANGED_READ_THRESHOLD", str(64 * 1024 * 1024)))
+RANGE_PART_SIZE = int(os.environ.get("RANGE_PART_SIZE", str(8 * 1024 * 1024)))
+RANGE_READ_AHEAD = int(os.environ.get("RANGE_READ_AHEAD", "4"))
+
+class TransferTelemetry:
+    """
+    Stage timings, per-file and per-worker volumes and connection counts for one
+    invocation, emitted as CloudWatch Embedded Metric Format log lines.
+    """
+
+    def __init__(self, template_type=None):
+        self.template_type = template_type
+        self._lock = threading.Lock()
+        self.stages = defaultdict(lambda: [0, 0.0])  # stage -> [count, total seconds]
+        self.counters = defaultdict(int)
+        self.files = []  # (worker id, file name, bytes, seconds)
+        self.workers = defaultdict(lambda: {'files': 0, 'bytes': 0, 'seconds': 0.0})
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+
+    def record_stage(self, name, seconds):
+        with self._lock:
+            self.stages[name][0] += 1
+            self.stages[name][1] += seconds
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def record_file(self, worker_id, filename, nbytes, seconds):
+        with self._lock:
+            self.files.append((worker_id, filename, nbytes, seconds))
+            worker = self.workers[worker_id]
+            worker['files'] += 1
+            worker['bytes'] += nbytes
+            worker['seconds'] += seconds
+
+    def _emf(self, dimensions, metrics, properties):
+        line = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+                }]
+            },
+            **dimensions,
+            **{name: value for name, (value, _) in metrics.items()},
+            **properties
+        }
+        # EMF lines must reach CloudWatch Logs as bare JSON, without the logger prefix
+        print(json.dumps(line, default=str))
+        return line
+
+    def emit(self):
+        """Prints the EMF lines for this invocation and returns them."""
+        dimensions = {'TemplateType': self.template_type or 'UNKNOWN'}
+        with self._lock:
+            total_bytes = sum(f[2] for f in self.files)
+            summary = {
+                f"{''.join(p.title() for p in name.split('_'))}Seconds": (total, 'Seconds')
+                for name, (_, total) in self.stages.items()
+            }
+            summary.update({
+                ''.join(p.title() for p in name.split('_')): (value, 'Count')
+                for name, value in self.counters.items()
+            })
+            summary['FilesTransferred'] = (len(self.files), 'Count')
+            summary['BytesTransferred'] = (total_bytes, 'Bytes')
+            lines = [self._emf(dimensions, summary, {'StageCounts': {k: v[0] for k, v in self.stages.items()}})]
+
+            for worker_id, worker in sorted(self.workers.items()):
+                lines.append(self._emf({**dimensions, 'Worker': str(worker_id)}, {
+                    'WorkerFiles': (worker['files'], 'Count'),
+                    'WorkerBytes': (worker['bytes'], 'Bytes'),
+                    'WorkerThroughput': (worker['bytes'] / worker['seconds'] if worker['seconds'] else 0, 'Bytes/Second')
+                }, {}))
+
+            for worker_id, filename, nbytes, seconds in self.files:
+                lines.append(self._emf(dimensions, {
+                    'FileBytes': (nbytes, 'Bytes'),
+                    'FileSeconds': (seconds, 'Seconds'),
+                    'FileThroughput': (nbytes / seconds if seconds else 0, 'Bytes/Second')
+                }, {'FileName': filename, 'Worker': worker_id}))
+        return lines
+
+# Replaced at the start of each invocation
+telemetry = TransferTelemetry()
 
 def list_s3_files(s3_client, bucket, prefix):
+    """Returns {key: listing entry} for every object under the prefix, 1000 keys per request."""
     paginator = s3_client.get_paginator('list_objects_v2')
     page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix)
-    s3_keys = []
+    s3_objects = {}
     for page in page_iterator:
         for obj in page.get('Contents', []):
-            s3_keys.append(obj['Key'])
-    return s3_keys
+            s3_objects[obj['Key']] = obj
+    return s3_objects
+
+# --- Transfer checkpoints ---
+# A run writes <prefix>run.json with its SFTP folder and then one empty marker
+# under <prefix>done/ per delivered file. The markers are removed once STARTDMS
+# is written, so anything left behind belongs to a run that died midway.
+def load_checkpoint(s3_client, prefix):
+    try:
+        resp = s3_client.get_object(Bucket=s3_bucket, Key=f"{prefix}run.json")
+    except ClientError as e:
+        if e.response['Error']['Code'] == "NoSuchKey":
+            return None, {}
+        raise
+    run = json.loads(resp['Body'].read())
+
+    started_at = datetime.fromisoformat(run['started_at'])
+    age_hours = (datetime.now(ZoneInfo("UTC")) - started_at).total_seconds() / 3600
+    if age_hours > CHECKPOINT_MAX_AGE_HOURS:
+        logger.warning(f"Discarding stale checkpoint for {run['sftp_folder']} ({age_hours:.1f}h old)")
+        clear_checkpoint(s3_client, prefix)
+        return None, {}
+
+    done_prefix = f"{prefix}done/"
+    completed = {key[len(done_prefix):]: None for key in list_s3_files(s3_client, s3_bucket, done_prefix)}
+    return run, completed
+
+def load_checkpoint_digests(s3_client, prefix, completed):
+    """Fills in the checksums stored in the markers of already delivered files."""
+    def read_marker(filename):
+        body = s3_client.get_object(Bucket=s3_bucket, Key=f"{prefix}done/{filename}")['Body'].read()
+        return filename, body.decode() or None
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for filename, digest in executor.map(read_marker, list(completed)):
+            completed[filename] = digest
+
+def save_checkpoint(s3_client, prefix, run):
+    s3_client.put_object(Bucket=s3_bucket, Key=f"{prefix}run.json", Body=json.dumps(run))
+
+def record_checkpoint(s3_client, prefix, filename, digest=None):
+    try:
+        s3_client.put_object(Bucket=s3_bucket, Key=f"{prefix}done/{filename}", Body=(digest or "").encode())
+    except ClientError as e:
+        # The file itself is delivered; a lost marker only costs a re-send on resume
+        logger.warning(f"Could not checkpoint {filename}: {e}")
+
+def record_bundle_checkpoint(s3_client, prefix, bundle_name, members):
+    """Stores the bundles.csv rows of a renamed bundle, so a run that dies midway keeps them."""
+    rows = "".join(f"{bundle_name}|{filename}|{size}|{digest}\n" for filename, size, digest in members)
+    try:
+        s3_client.put_object(Bucket=s3_bucket, Key=f"{prefix}bundles/{bundle_name}", Body=rows.encode())
+    except ClientError as e:
+        logger.warning(f"Could not checkpoint bundle {bundle_name}: {e}")
+
+def load_bundle_checkpoints(s3_client, prefix, completed):
+    """
+    Returns the bundles.csv rows of the bundles an interrupted run delivered and
+    marks their members completed, in case the run died before their own markers.
+    """
+    bundles_prefix = f"{prefix}bundles/"
+
+    def read_marker(key):
+        return s3_client.get_object(Bucket=s3_bucket, Key=key)['Body'].read().decode()
+
+    rows = []
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for body in executor.map(read_marker, list(list_s3_files(s3_client, s3_bucket, bundles_prefix))):
+            for line in body.splitlines():
+                bundle_name, filename, size, digest = line.split("|")
+                rows.append((bundle_name, filename, int(size), digest))
+                completed.setdefault(filename, digest or None)
+    return rows
+
+def clear_checkpoint(s3_client, prefix):
+    keys = list(list_s3_files(s3_client, s3_bucket, prefix))
+    for i in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=s3_bucket,
+            Delete={'Objects': [{'Key': k} for k in keys[i:i + 1000]], 'Quiet': True}
+        )
 
 def ensure_sftp_path_exists(sftp_client, remote_path):
     try:
@@ -48,8 +280,9 @@ def ensure_sftp_path_exists(sftp_client, remote_path):
 
 # credentials
 def get_secret():
-    secrets_client = boto3.client('secretsmanager', region_name='eu-west-1')
-    resp = secrets_client.get_secret_value(SecretId=SECRET_NAME)
+    with telemetry.stage("secret_fetch"):
+        secrets_client = boto3.client('secretsmanager', region_name='eu-west-1')
+        resp = secrets_client.get_secret_value(SecretId=SECRET_NAME)
     return json.loads(resp['SecretString'])
 
 def get_db_credentials():
@@ -73,15 +306,51 @@ def get_sftp_credentials():
         'password': secret['sftpPassword']
     }
 
+def get_db_pool():
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None or db_pool.closed:
+            creds = get_db_credentials()
+            db_pool = ThreadedConnectionPool(
+                1, DB_POOL_SIZE,
+                dbname=creds['dbname'],
+                user=creds['user'],
+                password=creds['password'],
+                host=creds['host'],
+                port=creds['port'],
+                connect_timeout=10,
+                keepalives=1,
+                options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+            )
+        return db_pool
+
+@contextmanager
 def get_db_connection():
-    creds = get_db_credentials()
-    return psycopg2.connect(
-        dbname=creds['dbname'],
-        user=creds['user'],
-        password=creds['password'],
-        host=creds['host'],
-        port=creds['port']
-    )
+    """
+    Borrows a pooled connection, pinging it first and replacing it if it went stale.
+    The connection goes back to the pool afterwards, or is discarded if it broke.
+    """
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+    except psycopg2.Error as e:
+        logger.warning(f"Pooled DB connection is stale, reconnecting: {e}")
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    broken = True
+    try:
+        yield conn
+        broken = conn.closed
+    finally:
+        # Also reached when a caller abandons a streaming query part way
+        if broken:
+            pool.putconn(conn, close=True)
+        else:
+            conn.rollback()
+            pool.putconn(conn)
 
 def fetch_file_list(templateType):
     if(templateType=="CONTRATTO"):
@@ -110,10 +379,22 @@ def fetch_file_list(templateType):
     else:
         logger.error("Pass the correct Template Type")
 
+    # Server-side cursor: rows arrive FETCH_BATCH_SIZE at a time as named tuples
     with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(query)
-            return cur.fetchall()
+        with conn:
+            with conn.cursor(name="dmf_file_list", cursor_factory=NamedTupleCursor) as cur:
+                cur.itersize = FETCH_BATCH_SIZE
+                started = time.perf_counter()
+                cur.execute(query)
+                rows = iter(cur)
+                # A named cursor only runs the query on the first fetch
+                first_row = next(rows, None)
+                telemetry.record_stage("db_query", time.perf_counter() - started)
+                if first_row is None:
+                    return
+                yield first_row
+                for row in rows:
+                    yield row
 
 def mark_files_completed(schema, table, input_file_name, transferred_all, skipped_all):
     with get_db_connection() as conn:
@@ -150,77 +431,660 @@ def mark_files_completed(schema, table, input_file_name, transferred_all, skippe
             cur.execute(query_sp, (input_file_name,))
             conn.commit()
 
-def create_metadata_file(records, templateType):
+def metadata_format(templateType):
+    """Returns the columns left out of index.csv and the field delimiter."""
     if templateType == "CONTRATTO":
-        excluded_columns = []
-        delimiter = "||" 
+        return [], "||"
     elif templateType == "CGA":
-        excluded_columns = ["output_file_name"]
-        delimiter = "|" 
+        return ["output_file_name"], "|"
     elif templateType == "SOAS":
-        excluded_columns = ["input_file_name"]
-        delimiter = "#"
+        return ["input_file_name"], "#"
     elif templateType == "DIGITAL":
-        excluded_columns = ["input_file_name"]
-        delimiter = "#"
-    else:
-        delimiter = "#"
-    # Extract only values from each record dict
-    lines = []
+        return ["input_file_name"], "#"
+    return [], "#"
+
+def queue_records(records, templateType, s3Prefix, s3_objects, plan):
+    """
+    Yields (S3 key, index.csv line) for each record as rows stream in, leaving
+    out records whose object is not in `s3_objects`. `plan` collects the request
+    count, missing keys, input file names and listing entries.
+    """
+    excluded_columns, delimiter = metadata_format(templateType)
     for row in records:
-        filtered_row = {k: v for k, v in row.items() if k not in excluded_columns}
-        line = delimiter.join("" if v is None else str(v) for v in filtered_row.values())
-        lines.append(line)
-    filename = "index.csv"
-    return filename, "\n".join(lines)
+        plan['requested'] += 1
+        if 'input_file_name' in row._fields:
+            plan['input_files'].append(row.input_file_name)
+        key = os.path.join(s3Prefix, row.output_file_name)
+        if key not in s3_objects:
+            plan['missing_keys'].append(key)
+            continue
+        plan['objects'][key] = s3_objects[key]
+        plan['indexed'] += 1
+        yield key, delimiter.join(
+            "" if v is None else str(v) for k, v in zip(row._fields, row) if k not in excluded_columns
+        )
 
-def split_list(lst, n):
-    """Split list into n nearly equal chunks."""
-    k, m = divmod(len(lst), n)
-    return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
+def write_index(entries, metadata_file):
+    """
+    Writes the index.csv lines to `metadata_file` in METADATA_BUFFER_SIZE chunks
+    and yields each key, so its transfer is queued while rows still stream in.
+    """
+    buffer = io.StringIO()
+    first = True
+    for key, line in entries:
+        if not first:
+            buffer.write("\n")
+        first = False
+        buffer.write(line)
+        if buffer.tell() >= METADATA_BUFFER_SIZE:
+            metadata_file.write(buffer.getvalue())
+            buffer = io.StringIO()
+        yield key
+    metadata_file.write(buffer.getvalue())
 
-def create_sftp_connection():
+Bundle = namedtuple("Bundle", ["name", "format", "members"])  # members: [(key, index line)]
+
+def group_bundles(entries, bundle_format, objects, completed=frozenset()):
+    """
+    Groups the entries into Bundle work items of up to BUNDLE_MAX_FILES files and
+    BUNDLE_MAX_BYTES bytes. Files a resumed run already delivered pass through
+    as plain keys.
+    """
+    stamp = datetime.now(ZoneInfo("UTC")).strftime('%H%M%S')
+    members = []
+    size = 0
+    count = 0
+    for key, line in entries:
+        if os.path.basename(key) in completed:
+            yield key
+            continue
+        members.append((key, line))
+        size += objects[key]['Size']
+        if len(members) >= BUNDLE_MAX_FILES or size >= BUNDLE_MAX_BYTES:
+            count += 1
+            yield Bundle(f"bundle-{stamp}-{count:04d}.{bundle_format}", bundle_format, members)
+            members = []
+            size = 0
+    if members:
+        count += 1
+        yield Bundle(f"bundle-{stamp}-{count:04d}.{bundle_format}", bundle_format, members)
+
+def create_transport():
     sftp_creds = get_sftp_credentials()
-    transport = paramiko.Transport((sftp_creds['host'], sftp_creds['port']))
-    transport.connect(username=sftp_creds['username'], password=sftp_creds['password'])
+    with telemetry.stage("ssh_handshake"):
+        transport = paramiko.Transport(
+            (sftp_creds['host'], sftp_creds['port']),
+            default_window_size=SFTP_WINDOW_SIZE,
+            default_max_packet_size=SFTP_MAX_PACKET_SIZE
+        )
+        transport.connect(username=sftp_creds['username'], password=sftp_creds['password'])
+    telemetry.increment("ssh_connections")
+    return transport
+
+def create_sftp_connection():
+    transport = create_transport()
     sftp = paramiko.SFTPClient.from_transport(transport)
     return sftp, transport
 
-def transfer_file_batch(s3_client, s3_keys, sftp_dir):
+class SftpConnectionPool:
+    """Hands out SFTP channels, multiplexing up to `channels_per_connection` on each SSH transport."""
+
+    def __init__(self, channels_per_connection):
+        self.channels_per_connection = max(1, channels_per_connection)
+        self._lock = threading.Lock()
+        self._in_use = {}  # transport -> open channel count
+        self._owners = {}  # id(sftp) -> transport
+
+    def acquire(self):
+        with self._lock:
+            transport = next(
+                (t for t, n in self._in_use.items() if n < self.channels_per_connection and t.is_active()),
+                None
+            )
+            if transport is not None:
+                telemetry.increment("sftp_channel_reuse")
+                self._in_use[transport] += 1
+        if transport is None:
+            # Handshake outside the lock, so other workers keep acquiring channels meanwhile
+            transport = create_transport()
+            with self._lock:
+                self._in_use[transport] = 1
+        try:
+            sftp = paramiko.SFTPClient.from_transport(transport)
+        except Exception:
+            with self._lock:
+                self._in_use[transport] -= 1
+            raise
+        with self._lock:
+            self._owners[id(sftp)] = transport
+        telemetry.increment("sftp_channels")
+        return sftp
+
+    def release(self, sftp):
+        sftp.close()
+        with self._lock:
+            transport = self._owners.pop(id(sftp))
+            self._in_use[transport] -= 1
+            if not self._in_use[transport] and not transport.is_active():
+                # A dropped session is never handed out again
+                del self._in_use[transport]
+                transport.close()
+
+    def close(self):
+        with self._lock:
+            for transport in self._in_use:
+                transport.close()
+            self._in_use.clear()
+            self._owners.clear()
+
+def fetch_range(s3_client, key, start, end, buffer):
+    body = s3_client.get_object(Bucket=s3_bucket, Key=key, Range=f"bytes={start}-{end}")['Body']
+    length = 0
+    try:
+        for chunk in body.iter_chunks(chunk_size=S3_READ_CHUNK_SIZE):
+            buffer[length:length + len(chunk)] = chunk
+            length += len(chunk)
+    finally:
+        body.close()
+    if length != end - start + 1:
+        raise IOError(f"Short read on {key} bytes {start}-{end}: got {length}")
+    return buffer, length
+
+def iter_s3_ranges(s3_client, key, size):
+    """
+    Yields the object's bytes in order while up to RANGE_READ_AHEAD ranged GETs
+    are in flight. Each part is read into one of RANGE_READ_AHEAD reusable buffers,
+    and a buffer is only refilled once the consumer has taken its previous part,
+    so memory stays at RANGE_READ_AHEAD * RANGE_PART_SIZE per file.
+    """
+    part_count = -(-size // RANGE_PART_SIZE)
+    depth = min(RANGE_READ_AHEAD, part_count)
+    buffers = [bytearray(RANGE_PART_SIZE) for _ in range(depth)]
+    pending = deque()
+    next_part = 0
+
+    def submit(executor, buffer):
+        nonlocal next_part
+        start = next_part * RANGE_PART_SIZE
+        end = min(start + RANGE_PART_SIZE, size) - 1
+        pending.append(executor.submit(fetch_range, s3_client, key, start, end, buffer))
+        next_part += 1
+
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        try:
+            for buffer in buffers:
+                submit(executor, buffer)
+            while pending:
+                buffer, length = pending.popleft().result()
+                # The consumer must copy the view before asking for the next part
+                yield memoryview(buffer)[:length]
+                if next_part < part_count:
+                    submit(executor, buffer)
+        finally:
+            for future in pending:
+                future.cancel()
+
+def timed_first_chunk(chunks, started):
+    """Passes chunks through, recording the S3 time to first byte."""
+    first = True
+    for chunk in chunks:
+        if first:
+            telemetry.record_stage("s3_first_byte", time.perf_counter() - started)
+            first = False
+        yield chunk
+
+def put_stream(sftp_client, chunks, remote_path, hashers=()):
+    """
+    Pipelined upload of an iterable of byte chunks. Returns the number of bytes
+    written; `hashers` are updated with the same bytes on the way through.
+    """
+    size = 0
+    write_seconds = 0.0
+    started = time.perf_counter()
+    remote_file = sftp_client.file(remote_path, 'wb', bufsize=SFTP_REQUEST_SIZE)
+    with remote_file:
+        # Don't wait for each write's ack, and send larger write requests than paramiko's 32 KB default
+        remote_file.MAX_REQUEST_SIZE = SFTP_REQUEST_SIZE
+        remote_file.set_pipelined(True)
+        write_seconds += time.perf_counter() - started
+        for chunk in chunks:
+            for hasher in hashers:
+                hasher.update(chunk)
+            started = time.perf_counter()
+            remote_file.write(chunk)
+            write_seconds += time.perf_counter() - started
+            size += len(chunk)
+        started = time.perf_counter()
+    # Pipelined write errors only surface on close, so confirm the size like putfo does
+    remote_size = sftp_client.stat(remote_path).st_size
+    telemetry.record_stage("sftp_write", write_seconds + time.perf_counter() - started)
+    if remote_size != size:
+        raise IOError(f"Size mismatch for {remote_path}: sent {size} bytes, remote has {remote_size}")
+    return size
+
+def remote_file_size(sftp_client, remote_path):
+    try:
+        return sftp_client.stat(remote_path).st_size
+    except FileNotFoundError:
+        return None
+
+def create_startdms_file(sftp_dir):
+    sftp_dms, transport_dms = create_sftp_connection()
+    try:
+        with sftp_dms.file(os.path.join(sftp_dir, "STARTDMS"), 'w') as dms_file:
+            pass
+        logger.info("STARTDMS file created successfully.")
+    finally:
+        sftp_dms.close()
+        transport_dms.close()
+
+def verify_checksums(key, etag, md5, sha256, stored_sha256=None):
+    # Multipart ETags ("<hash>-<parts>") are not an MD5 of the content
+    if etag and '-' not in etag and md5.hexdigest() != etag:
+        raise IOError(f"MD5 mismatch for {key}: streamed {md5.hexdigest()}, ETag {etag}")
+    if stored_sha256 and sha256 and '-' not in stored_sha256:
+        streamed = base64.b64encode(sha256.digest()).decode()
+        if streamed != stored_sha256:
+            raise IOError(f"SHA-256 mismatch for {key}: streamed {streamed}, stored {stored_sha256}")
+
+def new_hashers():
+    """MD5 for the ETag check, plus SHA-256 when that is the manifest algorithm."""
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256() if CHECKSUM_ALGORITHM == "sha256" else None
+    return md5, sha256
+
+def open_s3_chunks(s3_client, key, s3_object):
+    """Returns the object's byte chunks plus the ETag and stored SHA-256 to verify them against."""
+    size = s3_object['Size']
+    etag = s3_object['ETag'].strip('"') if VERIFY_ETAG else None
+    started = time.perf_counter()
+    if size >= RANGED_READ_THRESHOLD:
+        # Large file: overlap S3 range fetches with the SFTP writes. Ranged GETs
+        # carry neither the full-object checksum nor a usable ETag, so take both
+        # (and the encryption mode) from a HEAD first.
+        head = s3_client.head_object(Bucket=s3_bucket, Key=key, ChecksumMode='ENABLED')
+        if head.get('ServerSideEncryption') == 'aws:kms':
+            etag = None
+        elif etag:
+            etag = head['ETag'].strip('"')
+        chunks = timed_first_chunk(iter_s3_ranges(s3_client, key, size), started)
+        return chunks, etag, head.get('ChecksumSHA256')
+    file_obj = s3_client.get_object(Bucket=s3_bucket, Key=key, ChecksumMode='ENABLED')
+    if file_obj.get('ServerSideEncryption') == 'aws:kms':
+        etag = None
+    elif etag:
+        etag = file_obj['ETag'].strip('"')
+    chunks = timed_first_chunk(file_obj['Body'].iter_chunks(chunk_size=S3_READ_CHUNK_SIZE), started)
+    return chunks, etag, file_obj.get('ChecksumSHA256')
+
+def transfer_file(s3_client, sftp, key, sftp_dir, objects, verify_remote=False):
+    """
+    Copies one S3 object to the SFTP folder, checksumming the bytes as they
+    stream. Returns the number of bytes sent and the CHECKSUM_ALGORITHM hex digest.
+    """
+    filename = os.path.basename(key)
+    sftp_path = os.path.join(sftp_dir, filename)
+    s3_object = objects[key]
+    if verify_remote and remote_file_size(sftp, sftp_path) == s3_object['Size']:
+        logger.info(f"Already complete on SFTP, skipping: {filename}")
+        return 0, None
+
+    md5, sha256 = new_hashers()
+    chunks, etag, stored_sha256 = open_s3_chunks(s3_client, key, s3_object)
+    nbytes = put_stream(sftp, chunks, sftp_path, [h for h in (md5, sha256) if h])
+    try:
+        verify_checksums(key, etag, md5, sha256, stored_sha256)
+    except IOError:
+        # Don't leave a corrupt copy where DMS would pick it up
+        sftp.remove(sftp_path)
+        raise
+    return nbytes, (sha256 or md5).hexdigest()
+
+class ChunkReader:
+    """Minimal read() over an iterator of byte chunks, hashing them as they pass, for tarfile."""
+
+    def __init__(self, chunks, hashers=()):
+        self._chunks = iter(chunks)
+        self._hashers = hashers
+        self._chunk = memoryview(b"")
+        self._offset = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                for hasher in self._hashers:
+                    hasher.update(chunk)
+                self._chunk = memoryview(chunk)
+                self._offset = 0
+            take = len(self._chunk) - self._offset if size < 0 else min(size, len(self._chunk) - self._offset)
+            # Copied now: asking for the next chunk may hand this buffer back for refill
+            parts.append(bytes(self._chunk[self._offset:self._offset + take]))
+            self._offset += take
+            if size > 0:
+                size -= take
+        return b"".join(parts)
+
+class StreamWriter:
+    """Write-only view of a remote file, so zipfile streams with data descriptors instead of seeking back."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def write(self, data):
+        self._fileobj.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+def add_archive_member(archive, name, size, reader):
+    if isinstance(archive, tarfile.TarFile):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        archive.addfile(info, reader)
+        return
+    info = zipfile.ZipInfo(name, date_time=datetime.now().timetuple()[:6])
+    info.external_attr = 0o644 << 16
+    with archive.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+        shutil.copyfileobj(reader, member, S3_READ_CHUNK_SIZE)
+
+def transfer_bundle(s3_client, sftp, bundle, sftp_dir, objects):
+    """
+    Streams the bundle's files straight from S3 into one tar or zip archive on
+    SFTP, with an index.csv member holding their index lines. The archive is
+    written under a .part name and renamed once complete. Returns the bytes
+    written and (file name, size, digest) for each member.
+    """
+    sftp_path = os.path.join(sftp_dir, bundle.name)
+    part_path = f"{sftp_path}.part"
+    members = []
+    remote_file = sftp.file(part_path, 'wb', bufsize=SFTP_REQUEST_SIZE)
+    try:
+        with remote_file:
+            remote_file.MAX_REQUEST_SIZE = SFTP_REQUEST_SIZE
+            remote_file.set_pipelined(True)
+            writer = StreamWriter(remote_file)
+            if bundle.format == "tar":
+                archive = tarfile.open(fileobj=writer, mode='w|')
+            else:
+                archive = zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+            with archive:
+                for key, _ in bundle.members:
+                    filename = os.path.basename(key)
+                    s3_object = objects[key]
+                    md5, sha256 = new_hashers()
+                    chunks, etag, stored_sha256 = open_s3_chunks(s3_client, key, s3_object)
+                    add_archive_member(archive, filename, s3_object['Size'],
+                                       ChunkReader(chunks, [h for h in (md5, sha256) if h]))
+                    verify_checksums(key, etag, md5, sha256, stored_sha256)
+                    members.append((filename, s3_object['Size'], (sha256 or md5).hexdigest()))
+                index = "\n".join(line for _, line in bundle.members).encode()
+                add_archive_member(archive, METADATA_FILENAME, len(index), io.BytesIO(index))
+        nbytes = sftp.stat(part_path).st_size
+        try:
+            sftp.posix_rename(part_path, sftp_path)
+        except IOError:
+            # Server without the posix-rename extension
+            sftp.rename(part_path, sftp_path)
+    except Exception:
+        try:
+            sftp.remove(part_path)
+        except IOError:
+            pass
+        raise
+    return nbytes, members
+
+def item_keys(item):
+    return [key for key, _ in item.members] if isinstance(item, Bundle) else [item]
+
+class AdaptiveConcurrency:
+    """
+    AIMD control of the number of SFTP transfer workers, between `min_workers`
+    and `max_workers`. Once per `interval` seconds the aggregate throughput is
+    compared with the previous interval: one worker is added while it keeps
+    rising, and the target is halved on SSH handshake failures or when the
+    share of failed files exceeds `max_error_rate`.
+    """
+
+    def __init__(self, min_workers, max_workers, initial_workers, interval, max_error_rate, min_gain, clock=time.monotonic):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.target = min(max(initial_workers, self.min_workers), self.max_workers)
+        self.interval = interval
+        self.max_error_rate = max_error_rate
+        self.min_gain = min_gain
+        self.consecutive_handshake_failures = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._window_start = clock()
+        self._last_throughput = 0.0
+        self._reset_window()
+
+    def _reset_window(self):
+        self._bytes = 0
+        self._files = 0
+        self._errors = 0
+        self._handshake_failures = 0
+
+    def record_transfer(self, nbytes):
+        with self._lock:
+            self._bytes += nbytes
+            self._files += 1
+            self.consecutive_handshake_failures = 0
+
+    def record_error(self):
+        with self._lock:
+            self._errors += 1
+
+    def record_handshake_failure(self):
+        with self._lock:
+            self._handshake_failures += 1
+            self.consecutive_handshake_failures += 1
+
+    def adjust(self):
+        """Closes the current window once it is `interval` old and returns the worker target."""
+        with self._lock:
+            now = self._clock()
+            elapsed = now - self._window_start
+            if elapsed < self.interval:
+                return self.target
+            throughput = self._bytes / elapsed
+            attempts = self._files + self._errors
+            if self._handshake_failures or (attempts and self._errors / attempts > self.max_error_rate):
+                self.target = max(self.min_workers, self.target // 2)
+                logger.info(f"Backing off to {self.target} SFTP workers "
+                            f"({self._handshake_failures} handshake failures, {self._errors}/{attempts} errors)")
+            elif throughput > self._last_throughput * (1 + self.min_gain) and self.target < self.max_workers:
+                self.target += 1
+                logger.info(f"Throughput {throughput / 1e6:.2f} MB/s, raising to {self.target} SFTP workers")
+            self._last_throughput = throughput
+            self._window_start = now
+            self._reset_window()
+            return self.target
+
+def session_lost(sftp, error):
+    """True when a transfer failed because the SSH session died, not because of the file."""
+    if isinstance(error, (EOFError, ConnectionError, socket.timeout, paramiko.SSHException)):
+        return True
+    transport = sftp.get_channel().get_transport()
+    return transport is None or not transport.is_active()
+
+def transfer_worker(worker_id, s3_client, pool, work, feed_done, controller, sftp_dir, objects, digests, completed=None, checkpoint_prefix=None, verify_remote=False, bundle_manifest=None):
+    """
+    Drains keys and bundles from `work` until the feed is exhausted or the
+    controller's target drops below this worker. Returns the transferred and
+    failed items, and whether the worker stopped because it had no usable SFTP
+    session; the item in hand then goes back on the queue for a fresh session.
+    """
+    completed = completed if completed is not None else {}
     transferred = []
     failed = []
-    sftp, transport = create_sftp_connection()
     try:
-        for key in s3_keys:
+        sftp = pool.acquire()
+    except Exception as e:
+        logger.warning(f"Worker {worker_id} could not open an SFTP session: {e}")
+        controller.record_handshake_failure()
+        return transferred, failed, True
+    try:
+        while worker_id < controller.target:
+            try:
+                key = work.get(timeout=0.5)
+            except queue.Empty:
+                if feed_done.is_set():
+                    break
+                continue
+            if isinstance(key, Bundle):
+                bundle = key
+                try:
+                    started = time.perf_counter()
+                    nbytes, members = transfer_bundle(s3_client, sftp, bundle, sftp_dir, objects)
+                    telemetry.record_file(worker_id, bundle.name, nbytes, time.perf_counter() - started)
+                    if checkpoint_prefix:
+                        # The archive is renamed into place; keep its manifest rows before anything else
+                        record_bundle_checkpoint(s3_client, checkpoint_prefix, bundle.name, members)
+                    for filename, size, digest in members:
+                        if checkpoint_prefix:
+                            record_checkpoint(s3_client, checkpoint_prefix, filename, digest)
+                        transferred.append(filename)
+                        digests[filename] = digest
+                        bundle_manifest.append((bundle.name, filename, size, digest))
+                    controller.record_transfer(nbytes)
+                except Exception as e:
+                    if session_lost(sftp, e):
+                        logger.warning(f"Worker {worker_id} lost its SFTP session, requeueing {bundle.name}: {e}")
+                        work.put(bundle)
+                        controller.record_handshake_failure()
+                        return transferred, failed, True
+                    logger.error(f"Failed to transfer bundle {bundle.name}: {e}", exc_info=True)
+                    failed.extend(item_keys(bundle))
+                    controller.record_error()
+                continue
             filename = os.path.basename(key)
-            sftp_path = os.path.join(sftp_dir, filename)
+            if filename in completed:
+                transferred.append(filename)
+                digests[filename] = completed[filename]
+                continue
             try:
-                file_obj = s3_client.get_object(Bucket=s3_bucket, Key=key)
-                file_stream = file_obj['Body']
-                sftp.putfo(file_stream, sftp_path)
+                started = time.perf_counter()
+                nbytes, digest = transfer_file(s3_client, sftp, key, sftp_dir, objects, verify_remote)
+                telemetry.record_file(worker_id, filename, nbytes, time.perf_counter() - started)
                 # logger.info(f"Transferred: {filename}")
+                if checkpoint_prefix:
+                    record_checkpoint(s3_client, checkpoint_prefix, filename, digest)
                 transferred.append(filename)
+                digests[filename] = digest
+                controller.record_transfer(nbytes)
             except ClientError as e:
                 if e.response['Error']['Code'] == "NoSuchKey":
                     logger.warning(f"S3 key not found, skipping: {key}")
                 else:
                     logger.error(f"Failed to get object {key}: {e}", exc_info=True)
                 failed.append(key)
+                controller.record_error()
             except Exception as e:
+                if session_lost(sftp, e):
+                    logger.warning(f"Worker {worker_id} lost its SFTP session, requeueing {key}: {e}")
+                    work.put(key)
+                    controller.record_handshake_failure()
+                    return transferred, failed, True
                 logger.error(f"Failed to transfer {key}: {e}", exc_info=True)
                 failed.append(key)
+                controller.record_error()
     finally:
-        sftp.close()
-        transport.close()
-    return transferred,failed
+        pool.release(sftp)
+    return transferred, failed, False
+
+def run_transfers(s3_client, s3_keys, sftp_dir, objects, digests, completed=None, checkpoint_prefix=None, verify_remote=False, bundle_manifest=None, pool=None, clock=time.monotonic):
+    """
+    Transfers the keys (or Bundles) with a worker count steered by AdaptiveConcurrency.
+    `s3_keys` may be a generator; it is drained on its own thread while workers run.
+    The checksum of each delivered file is stored in `digests`, and the archive
+    member of each bundled file is appended to `bundle_manifest`. `pool` and
+    `clock` can be replaced, e.g. by a simulated SFTP server and time.
+    """
+    work = queue.Queue()
+    feed_done = threading.Event()
+
+    def feed():
+        try:
+            for key in s3_keys:
+                work.put(key)
+        finally:
+            feed_done.set()
+
+    controller = AdaptiveConcurrency(
+        MIN_THREADS, MAX_THREADS, INITIAL_THREADS,
+        CONCURRENCY_INTERVAL_SECONDS, CONCURRENCY_MAX_ERROR_RATE, CONCURRENCY_MIN_GAIN,
+        clock=clock
+    )
+    transferred_all = []
+    failed_all = []
+    active = {}  # worker id -> future
+    retry_at = {}  # worker id -> clock time its slot may be refilled after a failed handshake
+    pool = pool or SftpConnectionPool(SFTP_CHANNELS_PER_CONNECTION)
+    try:
+        with ThreadPoolExecutor(max_workers=controller.max_workers + 1) as executor:
+            feeder = executor.submit(feed)
+            while True:
+                for worker_id, future in list(active.items()):
+                    if future.done():
+                        transferred, failed, lost_session = future.result()
+                        del active[worker_id]
+                        transferred_all.extend(transferred)
+                        failed_all.extend(failed)
+                        if lost_session:
+                            # Don't keep hammering a server that is refusing or dropping sessions
+                            delay = SFTP_HANDSHAKE_BACKOFF_SECONDS * 2 ** (controller.consecutive_handshake_failures - 1)
+                            retry_at[worker_id] = clock() + min(delay, SFTP_HANDSHAKE_BACKOFF_MAX_SECONDS)
+
+                if controller.consecutive_handshake_failures >= SFTP_MAX_HANDSHAKE_FAILURES and not active:
+                    logger.error(f"Giving up after {controller.consecutive_handshake_failures} failed SFTP handshakes")
+                    feed_done.wait()
+                    while not work.empty():
+                        failed_all.extend(item_keys(work.get_nowait()))
+                if feed_done.is_set() and work.empty() and not active:
+                    break
+
+                target = controller.adjust()
+                # Worker ids stay compact, so the ones at or above the target retire
+                for worker_id in range(target):
+                    if work.empty():
+                        break
+                    if worker_id not in active and retry_at.get(worker_id, clock()) <= clock():
+                        active[worker_id] = executor.submit(
+                            transfer_worker, worker_id, s3_client, pool, work, feed_done, controller, sftp_dir,
+                            objects, digests, completed, checkpoint_prefix, verify_remote, bundle_manifest
+                        )
+                pending = list(active.values()) + ([] if feeder.done() else [feeder])
+                if pending:
+                    wait(pending, timeout=SCHEDULER_TICK_SECONDS, return_when=FIRST_COMPLETED)
+                else:
+                    # Every slot is backing off after failed handshakes
+                    time.sleep(SCHEDULER_TICK_SECONDS)
+            # Surface a failure of the DB stream feeding the queue
+            feeder.result()
+    finally:
+        pool.close()
+    return transferred_all, failed_all
 
 def lambda_handler(event, context):
+    global telemetry
+    telemetry = TransferTelemetry(event.get("templateType") or "CGA")
     try:
 
         #Event Inputs
         templateType = event.get("templateType") or "CGA"
         sftpTargetDir = event.get("sftpTargetDir") or "/cga/"
         s3Prefix = event.get("s3Prefix") or "quill/CGA/"
+        # Optional "tar" or "zip": stream files into archives instead of one SFTP file each
+        bundleFormat = event.get("bundleFormat")
+        if bundleFormat not in (None, "tar", "zip"):
+            raise ValueError(f"Unsupported bundleFormat: {bundleFormat}")
 
         logger.info(f"templateType: {templateType}")
         logger.info(f"sftpTargetDir: {sftpTargetDir}")
@@ -233,73 +1097,120 @@ def lambda_handler(event, context):
         )
 
         s3 = boto3.client('s3')
+        checkpoint_prefix = f"{CHECKPOINT_PREFIX}{templateType}/"
+        checkpoint, completed = load_checkpoint(s3, checkpoint_prefix)
+        if checkpoint and checkpoint.get('archived'):
+            # Everything was delivered and archived, only STARTDMS is missing
+            create_startdms_file(checkpoint['sftp_folder'])
+            clear_checkpoint(s3, checkpoint_prefix)
+            checkpoint, completed = None, {}
+
+        # Resolve keys against one prefix listing instead of a GET per missing file
+        s3_objects = list_s3_files(s3, s3_bucket, s3Prefix)
+
         records = fetch_file_list(templateType)
-        if not records:
+        first_record = next(records, None)
+        if first_record is None:
             logger.info({'statusCode': 200, 'body': 'No files to transfer.'})
             return {'statusCode': 200, 'body': 'No files to transfer.'}
+        records = itertools.chain([first_record], records)
 
-        output_files = [r['output_file_name'] for r in records]
-        # logger.info(output_files)
-        s3_keys = [os.path.join(s3Prefix, f) for f in output_files]
-        # s3_keys = list_s3_files(s3, s3_bucket, s3Prefix)
-
-        logger.info(f"s3_keys: {s3_keys}")
+        # Resume into the folder of an interrupted run, skipping files it already delivered
+        resumed = checkpoint is not None
+        if resumed:
+            sftp_date_hour_folder = checkpoint['sftp_folder']
+            logger.info(f"Resuming interrupted transfer into {sftp_date_hour_folder}, {len(completed)} files already delivered")
+        else:
+            checkpoint = {
+                'sftp_folder': sftp_date_hour_folder,
+                'started_at': datetime.now(ZoneInfo("UTC")).isoformat()
+            }
+            save_checkpoint(s3, checkpoint_prefix, checkpoint)
+        verify_remote = VERIFY_REMOTE_SIZE and resumed
+        if resumed and CHECKSUM_MANIFEST:
+            load_checkpoint_digests(s3, checkpoint_prefix, completed)
 
-        # Metadata file creation
-        metadata_filename, metadata_content = create_metadata_file(records,templateType)
         sftp_meta, transport_meta = create_sftp_connection()
+        try:
+            #Ensure SFTP File Path Exists
+            ensure_sftp_path_exists(sftp_meta, sftp_date_hour_folder)
 
-        #Ensure SFTP File Path Exists
-        ensure_sftp_path_exists(sftp_meta, sftp_date_hour_folder)
-
-        with sftp_meta.file(os.path.join(sftp_date_hour_folder, metadata_filename), 'w') as f:
-            f.write(metadata_content)
-        logger.info(f"Metadata file {metadata_filename} uploaded.")
-        sftp_meta.close()
-        transport_meta.close()
+            # Stream index.csv while its files are queued for transfer,
+            # several SFTP channels per SSH connection
+            plan = {'requested': 0, 'indexed': 0, 'input_files': [], 'missing_keys': [], 'objects': {}}
+            entries = queue_records(records, templateType, s3Prefix, s3_objects, plan)
+            digests = {}
+            if bundleFormat:
+                metadata_filename = BUNDLE_MANIFEST_FILENAME
+                bundle_manifest = []
+                if resumed:
+                    # Rows of the bundles the interrupted run delivered come from their markers
+                    bundle_manifest = load_bundle_checkpoints(s3, checkpoint_prefix, completed)
+                    recorded = {row[0] for row in bundle_manifest}
+                    for name in sftp_meta.listdir(sftp_date_hour_folder):
+                        # Half-written archives, and archives renamed just before the run
+                        # died without their rows; their files are bundled again
+                        orphaned = name.startswith("bundle-") and name not in recorded
+                        if name.endswith(".part") or orphaned:
+                            sftp_meta.remove(os.path.join(sftp_date_hour_folder, name))
+                transferred_all, failed_all = run_transfers(
+                    s3, group_bundles(entries, bundleFormat, plan['objects'], completed), sftp_date_hour_folder,
+                    plan['objects'], digests, completed, checkpoint_prefix, verify_remote, bundle_manifest
+                )
+                with sftp_meta.file(os.path.join(sftp_date_hour_folder, metadata_filename), 'w') as f:
+                    f.write("".join(f"{b}|{m}|{size}|{digest}\n" for b, m, size, digest in bundle_manifest))
+                logger.info(f"Bundle manifest {metadata_filename} uploaded with {len(bundle_manifest)} entries.")
+            else:
+                metadata_filename = METADATA_FILENAME
+                with sftp_meta.file(os.path.join(sftp_date_hour_folder, metadata_filename), 'w') as f:
+                    f.set_pipelined(True)
+                    transferred_all, failed_all = run_transfers(
+                        s3, write_index(entries, f), sftp_date_hour_folder,
+                        plan['objects'], digests, completed, checkpoint_prefix, verify_remote
+                    )
+                logger.info(f"Metadata file {metadata_filename} uploaded with {plan['indexed']} entries.")
 
-        # Split list into chunks
-        chunks = split_list(s3_keys, MAX_THREADS)
+            if CHECKSUM_MANIFEST:
+                manifest_name = f"checksums.{CHECKSUM_ALGORITHM}"
+                with sftp_meta.file(os.path.join(sftp_date_hour_folder, manifest_name), 'w') as f:
+                    f.set_pipelined(True)
+                    f.write("".join(f"{digests[name] or ''}  {name}\n" for name in transferred_all))
+                logger.info(f"Checksum manifest {manifest_name} uploaded.")
+        finally:
+            sftp_meta.close()
+            transport_meta.close()
 
-        # Run transfer in parallel
-        transferred_all = []
-        failed_all = []
-        with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-            futures = [executor.submit(transfer_file_batch, s3, chunk, sftp_date_hour_folder) for chunk in chunks]
-            for future in as_completed(futures):
-                transferred, failed = future.result()
-                transferred_all.extend(transferred)
-                failed_all.extend(failed)
+        missing_keys = plan['missing_keys']
+        if missing_keys:
+            logger.warning(f"S3 keys not found, skipping: {missing_keys}")
+        failed_all = missing_keys + failed_all
 
         # Update DB
         if transferred_all and templateType!="CGA":
-            input_files = [r['input_file_name'] for r in records]
-            mark_files_completed(schema, table, input_files, transferred_all, failed_all)
+            with telemetry.stage("db_update"):
+                mark_files_completed(schema, table, plan['input_files'], transferred_all, failed_all)
             logger.info("DB updated successfully.")
+            checkpoint['archived'] = True
+            save_checkpoint(s3, checkpoint_prefix, checkpoint)
 
         # Create STARTDMS file
-        sftp_dms, transport_dms = create_sftp_connection()
-        try:
-            with sftp_dms.file(os.path.join(sftp_date_hour_folder, "STARTDMS"), 'w') as dms_file:
-                pass
-            logger.info("STARTDMS file created successfully.")
-        finally:
-            sftp_dms.close()
-            transport_dms.close()
+        create_startdms_file(sftp_date_hour_folder)
+        clear_checkpoint(s3, checkpoint_prefix)
 
         logger.info({
                 'metadata_file': metadata_filename,
-                'total_files_requested': len(s3_keys),
+                'total_files_requested': plan['requested'],
                 'files_transferred': len(transferred_all),
                 'transferred_files': transferred_all,
                 'sftp_prefix': sftp_date_hour_folder,
                 'failed_files': failed_all
             })
+        telemetry.emit()
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'metadata_file': metadata_filename,
-                'total_files_requested': len(s3_keys),
+                'total_files_requested': plan['requested'],
                 'files_transferred': len(transferred_all),
                 'transferred_files': transferred_all,
                 'sftp_prefix': sftp_date_hour_folder,
@@ -309,6 +1220,7 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error(f"Lambda error: {e}", exc_info=True)
+        telemetry.emit()
         return {
             'statusCode': 500,
             'body': str(e)
@@ -3,6 +3,13 @@ import boto3
 import os
 import base64
 import time
+import threading
+import uuid
+import csv
+import io
+import tempfile
+import urllib.parse
+import urllib.request
 from datetime import datetime, timezone,timedelta
 import jwt
 from cryptography.hazmat.primitives import serialization
@@ -16,6 +23,33 @@ LOGIN_URL = ''
 APPFLOW_SECRET_NAME = os.environ.get('APPFLOW_SECRET_NAME')
 SECRET_NAME = os.environ['SECRET_NAME']
 PRIVATE_KEY_CONTENT=''
+# Task tokens of executions waiting for their flow run to finish; the rds-connector
+# describes the lifecycle of the objects under this prefix
+CALLBACK_BUCKET = os.environ.get('CALLBACK_BUCKET')
+CALLBACK_PREFIX = 'phoenix-automation/callbacks/'
+# A token older than this is replaced (it is signed for 120 minutes)
+TOKEN_REFRESH_AFTER = timedelta(minutes=90)
+
+# Warm-container cache: parsed signing key and when the stored token goes stale
+cached_private_key = None
+token_fresh_until = None
+token_lock = threading.Lock()
+
+# Automations loaded through Salesforce Bulk API 2.0 instead of their flow, e.g.
+# {"asset_product_termination_updater": {"object": "Asset", "operation": "update",
+#  "source_key": "phoenix-automation/appflow-data/asset-product-termination-updater/contact_status.csv"}}
+BULK_API_AUTOMATIONS = json.loads(os.environ.get('BULK_API_AUTOMATIONS', '{}'))
+BULK_API_VERSION = os.environ.get('BULK_API_VERSION', 'v60.0')
+# Source bucket and the bucket failed-records CSVs are written to
+BULK_S3_BUCKET = os.environ.get('S3_TARGET_BUCKET')
+# Salesforce accepts up to 150 MB per ingest job upload; larger sets are split into several jobs
+BULK_JOB_MAX_BYTES = int(os.environ.get('BULK_JOB_MAX_BYTES', str(100 * 1024 * 1024)))
+# Time kept free at the end of an invocation when polling jobs
+BULK_POLL_MARGIN_SECONDS = int(os.environ.get('BULK_POLL_MARGIN_SECONDS', '30'))
+BULK_FINAL_STATES = ('JobComplete', 'Failed', 'Aborted')
+
+# Bulk API access token from the JWT bearer exchange, reused while valid
+bulk_access = None
 
 def setSecrets():
     try:
@@ -39,20 +73,10 @@ def setSecrets():
         }
 
 
-def checkForConnections():
-    try:
-        secrets_client = boto3.client('secretsmanager', region_name='eu-west-1')
-        resp = secrets_client.get_secret_value(SecretId=APPFLOW_SECRET_NAME)
-        secret = json.loads(resp['SecretString'])
-        lastUpdatedAt = secret.get('lastUpdated')
-        return lastUpdatedAt
-
-    except Exception as e:
-        print(f"Error occurred: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
-        }
+def read_connection_secret():
+    """The AppFlow connection secret with its version id, used to make the refresh conditional."""
+    resp = secrets_client.get_secret_value(SecretId=APPFLOW_SECRET_NAME)
+    return json.loads(resp['SecretString']), resp['VersionId']
 
 
 def generateToken():
@@ -76,34 +100,68 @@ def generateToken():
             'body': json.dumps({'error': str(e)})
         }
 
-def updateconnection(token):
+def updateconnection(token, current_secret, version_id):
+    """
+    Writes the new JWT as a new secret version. The request token is derived from the
+    version we read, so callers that raced on the same stale version collide and only
+    the first write wins. Returns False when another caller already rotated it.
+    """
+    # Update only the JWT token value and lastupdated time
+    current_secret['jwtToken'] = token
+    current_secret['lastUpdated'] = datetime.utcnow().isoformat()
     try:
-        # Get current secret value
-        response = secrets_client.get_secret_value(SecretId=APPFLOW_SECRET_NAME)
-        current_secret = json.loads(response['SecretString'])
-
-        # Update only the JWT token value and lastupdated time
-        current_secret['jwtToken'] = token
-        current_secret['lastUpdated'] = datetime.utcnow().isoformat()
-
-        # Update the secret with modified values
         secrets_client.update_secret(
             SecretId=APPFLOW_SECRET_NAME,
-            SecretString=json.dumps(current_secret)
+            SecretString=json.dumps(current_secret),
+            ClientRequestToken=str(uuid.uuid5(uuid.NAMESPACE_URL, f"{APPFLOW_SECRET_NAME}/{version_id}"))
         )
-
-        return {'status': 'success', 'message': f'JWT updated in {APPFLOW_SECRET_NAME}'}
-
-    except Exception as e:
-        print(f"Error occurred: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
-        }
+    except secrets_client.exceptions.ResourceExistsException:
+        return False
+    return True
+
+
+def ensure_connection_token():
+    """
+    Makes sure the AppFlow connection holds a fresh JWT. A warm container answers from
+    its cache without reading any secret; only one caller per stale version signs and writes.
+    """
+    global token_fresh_until
+    with token_lock:
+        if token_fresh_until and datetime.utcnow() < token_fresh_until:
+            print("Connection is up to date")
+            return
+
+        current_secret, version_id = read_connection_secret()
+        lastUpdatedAt = current_secret.get('lastUpdated')
+        if lastUpdatedAt:
+            fresh_until = datetime.fromisoformat(lastUpdatedAt) + TOKEN_REFRESH_AFTER
+            if datetime.utcnow() < fresh_until:
+                token_fresh_until = fresh_until
+                print("Connection is up to date")
+                return
+
+        #generating a new token as the stored one was created more than 90 mins ago
+        if not CLIENT_ID:
+            setSecrets()
+            if not CLIENT_ID:
+                raise ValueError("Error in loading Salesforce secrets")
+        token = generateToken()
+        if isinstance(token, dict) and token.get('statusCode') == 500:
+            raise ValueError("Error in generating token")
+
+        if updateconnection(token, current_secret, version_id):
+            print("New Token Generated and updated in Secrets Manager")
+        else:
+            print("Token already refreshed by a concurrent execution")
+            current_secret, _ = read_connection_secret()
+        token_fresh_until = datetime.fromisoformat(current_secret['lastUpdated']) + TOKEN_REFRESH_AFTER
 
 
 def get_private_key():
-    """Load private key from secrets"""
+    """Load private key from secrets, parsed once per warm container"""
+    global cached_private_key
+    if cached_private_key is not None:
+        return cached_private_key
 
     try:
         if PRIVATE_KEY_CONTENT:
@@ -121,6 +179,7 @@ def get_private_key():
                 key_bytes,
                 password=None
             )
+            cached_private_key = private_key
             return private_key
 
         raise ValueError("PRIVATE_KEY_CONTENT not found in environment variables")
@@ -128,40 +187,231 @@ def get_private_key():
     except Exception as e:
         raise Exception(f"Error loading private key: {str(e)}")
 
-def lambda_handler(event, context):
+def claim_callback(s3, execution_id):
+    """
+    True for the single caller, the completion event or a late registration, that
+    finishes this run's wait. The claim is a conditional create, so only one succeeds.
+    """
     try:
-        #set the secrets
+        s3.put_object(Bucket=CALLBACK_BUCKET, Key=f"{CALLBACK_PREFIX}{execution_id}.claimed", Body=b"", IfNoneMatch='*')
+        return True
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
+
+
+def register_callback(event):
+    """
+    Stores the Step Functions task token under the flow's executionId, for the
+    EventBridge handler in the rds-connector to resume the execution when the run ends.
+    """
+    body = event.get("body", {})
+    execution_id = body.get("execution_id")
+    task_token = event.get("task_token")
+    if not CALLBACK_BUCKET or not execution_id or not task_token:
+        raise ValueError("Callback mode needs CALLBACK_BUCKET, 'execution_id' and 'task_token'")
+
+    s3 = boto3.client('s3')
+    s3.put_object(
+        Bucket=CALLBACK_BUCKET,
+        Key=f"{CALLBACK_PREFIX}{execution_id}.json",
+        Body=json.dumps({"task_token": task_token, "body": body}).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+    # The run may have finished before the token was stored; the completion
+    # event left a marker then, so hand over to the polling path right away.
+    # The handler writes its marker before it looks for the token, so at least
+    # one of the two sees the other.
+    try:
+        s3.head_object(Bucket=CALLBACK_BUCKET, Key=f"{CALLBACK_PREFIX}{execution_id}.completed")
+    except s3.exceptions.ClientError:
+        print(f"Callback registered for execution {execution_id}")
+        return {"statusCode": 200, "body": body}
+
+    if not claim_callback(s3, execution_id):
+        # The completion event found the token after all and resumes the execution
+        print(f"Callback for execution {execution_id} already taken by its completion event")
+        return {"statusCode": 200, "body": body}
+
+    boto3.client('stepfunctions').send_task_failure(
+        taskToken=task_token,
+        error="FlowAlreadyCompleted",
+        cause=f"Flow run {execution_id} finished before its callback was registered"
+    )
+    s3.delete_object(Bucket=CALLBACK_BUCKET, Key=f"{CALLBACK_PREFIX}{execution_id}.json")
+    s3.delete_object(Bucket=CALLBACK_BUCKET, Key=f"{CALLBACK_PREFIX}{execution_id}.completed")
+    return {"statusCode": 200, "body": body}
+
+
+def salesforce_request(method, url, access_token=None, data=None, content_type='application/json'):
+    headers = {'Accept': 'application/json'}
+    if access_token:
+        headers['Authorization'] = f"Bearer {access_token}"
+    if data is not None:
+        headers['Content-Type'] = content_type
+    request = urllib.request.Request(url, data=data, headers=headers, method=method)
+    return urllib.request.urlopen(request, timeout=60)
+
+
+def bulk_session():
+    """Exchanges a JWT from generateToken for a Bulk API access token and instance URL."""
+    global bulk_access
+    if bulk_access and time.time() < bulk_access['expires']:
+        return bulk_access
+
+    if not CLIENT_ID:
         setSecrets()
+    assertion = generateToken()
+    if isinstance(assertion, dict) and assertion.get('statusCode') == 500:
+        raise ValueError("Error in generating token")
+
+    data = urllib.parse.urlencode({
+        'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
+        'assertion': assertion
+    }).encode('utf-8')
+    with salesforce_request('POST', f"{LOGIN_URL.rstrip('/')}/services/oauth2/token",
+                            data=data, content_type='application/x-www-form-urlencoded') as resp:
+        token = json.load(resp)
+    # Session lifetime is org-defined; renew well before the usual two hours
+    bulk_access = {
+        'access_token': token['access_token'],
+        'instance_url': token['instance_url'].rstrip('/'),
+        'expires': time.time() + 1800
+    }
+    return bulk_access
+
+
+def ingest_url(session, job_id=''):
+    return f"{session['instance_url']}/services/data/{BULK_API_VERSION}/jobs/ingest/{job_id}"
+
+
+def submit_bulk_job(session, config, csv_text):
+    """Creates one ingest job, uploads its CSV and closes it for processing."""
+    job = {
+        'object': config['object'],
+        'operation': config.get('operation', 'update'),
+        'contentType': 'CSV',
+        'lineEnding': 'LF'
+    }
+    if config.get('externalIdFieldName'):
+        job['externalIdFieldName'] = config['externalIdFieldName']
+    with salesforce_request('POST', ingest_url(session), session['access_token'], json.dumps(job).encode('utf-8')) as resp:
+        job_id = json.load(resp)['id']
+    salesforce_request('PUT', f"{ingest_url(session, job_id)}/batches", session['access_token'],
+                       csv_text.encode('utf-8'), content_type='text/csv').close()
+    salesforce_request('PATCH', ingest_url(session, job_id), session['access_token'],
+                       json.dumps({'state': 'UploadComplete'}).encode('utf-8')).close()
+    return job_id
+
+
+def start_bulk_load(body, config):
+    """
+    Streams the updater's CSV from S3 into as many ingest jobs as BULK_JOB_MAX_BYTES needs.
+    Salesforce splits each job into batches it processes in parallel.
+    """
+    session = bulk_session()
+    s3 = boto3.client('s3')
+    source = s3.get_object(Bucket=config.get('bucket', BULK_S3_BUCKET), Key=config['source_key'])['Body']
+    lines = (line.decode('utf-8') for line in source.iter_lines(keepends=True))
+    # csv re-serialises rows so quoted fields with line breaks stay in one job
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if not header:
+        raise ValueError(f"Bulk source {config['source_key']} is empty")
+
+    job_ids = []
+    buffer = None
+    for row in reader:
+        if buffer is None:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerow(header)
+        writer.writerow(row)
+        if buffer.tell() >= BULK_JOB_MAX_BYTES:
+            job_ids.append(submit_bulk_job(session, config, buffer.getvalue()))
+            buffer = None
+    if buffer is not None:
+        job_ids.append(submit_bulk_job(session, config, buffer.getvalue()))
+
+    print(f"Submitted {len(job_ids)} Bulk API ingest jobs for {body.get('automation_name')}: {job_ids}")
+    return job_ids
+
+
+def write_bulk_failures(session, job_ids, execution_id):
+    """
+    Writes the jobs' failed records to the same CSV checkForPartialFailure produces:
+    the record's fields plus the error's statusCode and message, columns sorted.
+    """
+    s3 = boto3.client('s3')
+    with tempfile.TemporaryFile() as raw:
+        spill = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+        writer = None
+        for job_id in job_ids:
+            with salesforce_request('GET', f"{ingest_url(session, job_id)}/failedResults/", session['access_token']) as resp:
+                reader = csv.DictReader(line.decode('utf-8') for line in resp)
+                for row in reader:
+                    code, _, message = (row.pop('sf__Error', '') or '').partition(':')
+                    row.pop('sf__Id', None)
+                    row.update({'statusCode': code, 'message': message})
+                    if writer is None:
+                        writer = csv.DictWriter(spill, fieldnames=sorted(row.keys()))
+                        writer.writeheader()
+                    writer.writerow(row)
+        if writer is None:
+            return
+        spill.flush()
+        raw.seek(0)
+        # Managed transfer uploads large files in multipart chunks
+        s3.upload_fileobj(
+            raw,
+            BULK_S3_BUCKET,
+            f'phoenix-automation/error-logs/failed_records_{execution_id}.csv',
+            ExtraArgs={'ContentType': 'text/csv'}
+        )
 
-        #check the token last updated time
-        lastUpdatedAt = checkForConnections()
-
-        if isinstance(lastUpdatedAt, dict) and lastUpdatedAt.get('statusCode') == 500:
-            raise ValueError("Error in getting last updated time")
 
-        hours_difference = 2
-        if lastUpdatedAt and lastUpdatedAt!='':
-                currentTimestamp = datetime.now().isoformat()
-                timestamp1 = datetime.fromisoformat(currentTimestamp)
-                timestamp2 = datetime.fromisoformat(lastUpdatedAt)
-                time_difference = timestamp1 - timestamp2
-                hours_difference = time_difference.total_seconds() / 3600
+def bulk_status(event, context):
+    """
+    Polls the run's ingest jobs with backoff until they finish or the invocation runs
+    short of time. Finished runs get their failures written and a bulk_result summary
+    that Step 3 records in the ledger.
+    """
+    body = event.get("body", {})
+    job_ids = body.get("bulk_jobs", [])
+    session = bulk_session()
+    delay = 2
+    while True:
+        jobs = []
+        for job_id in job_ids:
+            with salesforce_request('GET', ingest_url(session, job_id), session['access_token']) as resp:
+                jobs.append(json.load(resp))
+        if all(job['state'] in BULK_FINAL_STATES for job in jobs):
+            break
+        if context.get_remaining_time_in_millis() / 1000 < delay + BULK_POLL_MARGIN_SECONDS:
+            return {"statusCode": 200, "execution_state": "InProgress", "body": body}
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+
+    write_bulk_failures(session, job_ids, body["execution_id"])
+    body["bulk_result"] = {
+        "records_processed": sum(job.get('numberRecordsProcessed', 0) for job in jobs),
+        "records_failed": sum(job.get('numberRecordsFailed', 0) for job in jobs),
+        "errors": [f"{job['id']}: {job.get('errorMessage')}" for job in jobs if job['state'] != 'JobComplete'],
+        "completed_at": datetime.now(timezone.utc).isoformat()
+    }
+    return {"statusCode": 200, "execution_state": "Completed", "body": body}
 
-        #generating a new tokken if the token is created before 90 mins
-        if hours_difference < 1.5:
-            print("Connection is up to date")
-        else:
-            token=generateToken()
-            if isinstance(token, dict) and token.get('statusCode') == 500:
-                raise ValueError("Error in generating token")
 
-            updatedDetails=updateconnection(token)
-            if isinstance(token, dict) and token.get('statusCode') == 500:
-                raise ValueError("Error in updating secrets")
+def lambda_handler(event, context):
+    if event.get("action") == "register_callback":
+        return register_callback(event)
 
-            print("New Token Generated and updated in Secrets Manager")
+    try:
+        if event.get("action") == "bulk_status":
+            return bulk_status(event, context)
 
-        #Start the appflow
         body = event.get("body", {})
         automation_name = body.get("automation_name")
         total_records = body.get("total_records")
@@ -170,10 +420,34 @@ def lambda_handler(event, context):
         if not automation_name:
             raise ValueError("Missing 'automation_name' in input body")
 
+        # Automations configured for Bulk API 2.0 skip AppFlow altogether
+        if automation_name in BULK_API_AUTOMATIONS:
+            execution_id = f"bulk-{uuid.uuid4()}"
+            job_ids = start_bulk_load(body, BULK_API_AUTOMATIONS[automation_name])
+            result = {
+                "statusCode": 200,
+                "body": {
+                    "execution_id": execution_id,
+                    "total_records": total_records,
+                    "automation_name": automation_name,
+                    "id": record_id,
+                    "loader": "bulk",
+                    "bulk_jobs": job_ids
+                }
+            }
+            print("Lambda output:", json.dumps(result))
+            return result
+
+        #check the token last updated time and refresh it when stale
+        ensure_connection_token()
+
+        #Start the appflow
+
         # Initializing the AppFlow client
         appflow = boto3.client("appflow")
 
-        # Triggering AppFlow flow
+        # Triggering AppFlow flow; the start time bounds the status checker's history search
+        started_at = datetime.now(timezone.utc).isoformat()
         response = appflow.start_flow(flowName=automation_name)
         execution_id = response.get("executionId", "unknown")
 
@@ -184,7 +458,8 @@ def lambda_handler(event, context):
                 "execution_id": execution_id,
                 "total_records": total_records,
                 "automation_name": automation_name,
-                "id": record_id
+                "id": record_id,
+                "started_at": started_at
             }
         }
 
@@ -6,8 +6,10 @@ import os
 import io
 from urllib.parse import urlparse
 from botocore.exceptions import ClientError
-from datetime import datetime
+from datetime import datetime, timedelta
 import csv
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 def default_serializer(obj):
@@ -24,6 +26,40 @@ SECRET_NAME = os.environ['SECRET_NAME']
 SCHEMA_NAME = os.environ['SCHEMA_NAME']
 TABLE_NAME  = os.environ['TABLE_NAME']
 S3_BUCKET = os.environ['S3_TARGET_BUCKET']
+# Task tokens stored by the appflow-connector's register_callback action. The token
+# and the .completed marker are deleted once the wait is resolved; the .claimed marker
+# stays to turn away repeated events. Expire the prefix with an S3 lifecycle rule
+# (e.g. after 7 days, well past the callback wait) to drop those and the markers of
+# runs that never registered a callback.
+CALLBACK_BUCKET = os.environ.get('CALLBACK_BUCKET', S3_BUCKET)
+CALLBACK_PREFIX = 'phoenix-automation/callbacks/'
+# How long a just-started execution may stay missing from the run history
+EXECUTION_LOOKUP_GRACE_SECONDS = int(os.environ.get('EXECUTION_LOOKUP_GRACE_SECONDS', '300'))
+
+# Error logs parsed concurrently, and the size of each failed-records CSV part
+ERROR_LOG_WORKERS = int(os.environ.get('ERROR_LOG_WORKERS', '8'))
+ERROR_CSV_PART_SIZE = int(os.environ.get('ERROR_CSV_PART_SIZE', str(8 * 1024 * 1024)))
+
+# Optional re-drive of failed records whose Salesforce error code is transient; 0 attempts disables it
+REDRIVE_MAX_ATTEMPTS = int(os.environ.get('REDRIVE_MAX_ATTEMPTS', '0'))
+REDRIVE_BACKOFF_SECONDS = int(os.environ.get('REDRIVE_BACKOFF_SECONDS', '60'))
+REDRIVE_ERROR_CODES = set(os.environ.get('REDRIVE_ERROR_CODES', 'UNABLE_TO_LOCK_ROW,REQUEST_RUNNING_TOO_LONG,SERVER_UNAVAILABLE').split(','))
+
+# Bounds for the wait between status polls, and the wait used without any run history
+MIN_POLL_SECONDS = int(os.environ.get('MIN_POLL_SECONDS', '5'))
+MAX_POLL_SECONDS = int(os.environ.get('MAX_POLL_SECONDS', '300'))
+DEFAULT_POLL_SECONDS = int(os.environ.get('DEFAULT_POLL_SECONDS', '30'))
+# Records per second of recent runs, per automation
+throughput_history = {}
+
+# Finished executions are final; a warm container answers repeat lookups from here
+terminal_executions = {}
+
+# Statement timeout applied to the container's connection, in milliseconds
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', '30000'))
+
+# Connection kept open across invocations of a warm container
+db_conn = None
 
 # Boto3 client for Secrets Manager
 secrets_client = boto3.client('secretsmanager', region_name='eu-west-1')
@@ -47,9 +83,9 @@ def get_db_credentials():
         logger.error(f"Could not retrieve secret {SECRET_NAME}: {e}")
         raise
 
-def get_db_connection():
+def connect_db():
     """
-    Returns a new psycopg2 connection using credentials
+    Opens a new psycopg2 connection using credentials
     retrieved from Secrets Manager.
     """
     creds = get_db_credentials()
@@ -58,9 +94,79 @@ def get_db_connection():
         user     = creds['user'],
         password = creds['password'],
         host     = creds['host'],
-        port     = creds['port']
+        port     = creds['port'],
+        connect_timeout = 10,
+        keepalives = 1,
+        options  = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
     )
 
+def get_db_connection():
+    """
+    Returns the warm container's connection, reconnecting when it
+    was closed or no longer answers a ping. Callers must not close it.
+    """
+    global db_conn
+    if db_conn is not None and not db_conn.closed:
+        try:
+            # Also clears a transaction a failed caller left open
+            db_conn.rollback()
+            with db_conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            db_conn.rollback()
+            return db_conn
+        except psycopg2.Error as e:
+            logger.warning(f"Cached DB connection is stale, reconnecting: {e}")
+            try:
+                db_conn.close()
+            except psycopg2.Error:
+                pass
+    db_conn = connect_db()
+    return db_conn
+
+# Ledger statements, shared verbatim by the athena and rds connectors.
+# A run is keyed by automation and run date, so a retried Step 1 updates the same row.
+LEDGER_STATEMENTS = {
+    'ledger_start': f"""
+        INSERT INTO {SCHEMA_NAME}.{TABLE_NAME}
+            (automation_name, run_date, status, total_records, s3_file_name, start_date, end_date, stack_trace)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+        ON CONFLICT (automation_name, run_date)
+        DO UPDATE SET status = EXCLUDED.status,
+                      total_records = EXCLUDED.total_records,
+                      s3_file_name = EXCLUDED.s3_file_name,
+                      start_date = EXCLUDED.start_date,
+                      end_date = EXCLUDED.end_date,
+                      stack_trace = EXCLUDED.stack_trace,
+                      execution_id = NULL,
+                      passed_records = NULL,
+                      failed_records = NULL
+        RETURNING id
+    """,
+    'ledger_finish': f"""
+        UPDATE {SCHEMA_NAME}.{TABLE_NAME}
+        SET end_date = $1, total_records = $2, status = $3, stack_trace = $4,
+            execution_id = $5, passed_records = $6, failed_records = $7
+        WHERE id = $8
+    """,
+}
+# Connection the statements were last prepared on
+ledger_prepared_conn = None
+
+def prepare_ledger(conn):
+    """PREPAREs the ledger statements once per database session."""
+    global ledger_prepared_conn
+    if ledger_prepared_conn is conn:
+        return
+    with conn.cursor() as cur:
+        for name, statement in LEDGER_STATEMENTS.items():
+            cur.execute(f"PREPARE {name} AS {statement}")
+    conn.commit()
+    ledger_prepared_conn = conn
+
+def execute_ledger(cur, name, params):
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
 def update_db(data,automation_name,record_id,total_records,failure_rows):
     if failure_rows==0 and data[0]['executionStatus']=='Successful':
         last_updated = data[0]['lastUpdatedAt'].isoformat()
@@ -70,12 +176,12 @@ def update_db(data,automation_name,record_id,total_records,failure_rows):
         passed_records = data[0]['executionResult']['recordsProcessed']
         # Connect to the database
         conn = get_db_connection()
+        prepare_ledger(conn)
         cur = conn.cursor()
         # Update the database
-        cur.execute(f"UPDATE {SCHEMA_NAME}.{TABLE_NAME} SET end_date = '{last_updated}', total_records = {records_processed},status='COMPLETED',stack_trace='{execution_status}',execution_id='{execution_id}',passed_records={passed_records} WHERE id = {record_id}")
+        execute_ledger(cur, 'ledger_finish', (last_updated, records_processed, 'COMPLETED', execution_status, execution_id, passed_records, 0, record_id))
         conn.commit()
         cur.close()
-        conn.close()
         return True
     else:
         last_updated = data[0]['lastUpdatedAt'].isoformat()
@@ -88,89 +194,405 @@ def update_db(data,automation_name,record_id,total_records,failure_rows):
             status = 'PARTIAL_FAILURE'
         # Connect to the database
         conn = get_db_connection()
+        prepare_ledger(conn)
         cur = conn.cursor()
         # Update the database
-        cur.execute(f"UPDATE {SCHEMA_NAME}.{TABLE_NAME} SET end_date = '{last_updated}', total_records = {records_processed},status='{status}',stack_trace='Failure at Appflow, please check the CSV',execution_id='{execution_id}',passed_records={passed_records},failed_records={failure_rows} WHERE id = {record_id}")
+        execute_ledger(cur, 'ledger_finish', (last_updated, records_processed, status, 'Failure at Appflow, please check the CSV', execution_id, passed_records, failure_rows, record_id))
         conn.commit()
         cur.close()
-        conn.close()
         return True
 
-def checkForPartialFailure(execution_id):
+class MultipartCsvUpload:
+    """Text sink for csv.writer that uploads to S3 as multipart parts of ERROR_CSV_PART_SIZE bytes."""
+
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType='text/csv')['UploadId']
+        self.parts = []
+        self.buffer = io.BytesIO()
+
+    def write(self, text):
+        self.buffer.write(text.encode('utf-8'))
+        if self.buffer.tell() >= ERROR_CSV_PART_SIZE:
+            self.flush_part()
+
+    def flush_part(self):
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=self.buffer.getvalue()
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = io.BytesIO()
+
+    def complete(self):
+        # The last part may be below the 5 MB minimum
+        if self.buffer.tell() or not self.parts:
+            self.flush_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def parse_error_log(s3, key, spill, redrive_spill=None, field_map=None):
+    """
+    Streams one AppFlow error log, writing each failed record merged with each of its
+    errors to the spill file as a JSON line. Records failing only with REDRIVE_ERROR_CODES
+    also go to redrive_spill, renamed from Salesforce's field names back to the flow's
+    source columns through field_map. Returns the failed and retryable record counts,
+    one per record however many errors it has, and the keys seen.
+    """
+    count = 0
+    headers = set()
+    redrive_count = 0
+    redrive_headers = set()
+    body = s3.get_object(Bucket=S3_BUCKET, Key=key)['Body']
+    for line in body.iter_lines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            # Loop inside errorDetails list
+            for err_detail in item.get('errorDetails', []):
+                record_str = err_detail.get('record')
+                error_str = err_detail.get('error')
+
+                if not record_str or record_str == "null":
+                    continue
+
+                record = json.loads(record_str)
+                error_list = json.loads(error_str)  # list of error dicts
+
+                for error_obj in error_list:
+                    combined = {**record, **error_obj}  # merge record + error into one dict
+                    spill.write(json.dumps(combined) + "\n")
+                    headers.update(combined.keys())
+                # Counted per record, like redrive_count, so fold_redrive can subtract one from the other
+                count += 1
+
+                codes = {e.get('statusCode') or e.get('errorCode') for e in error_list}
+                if redrive_spill and codes and codes <= REDRIVE_ERROR_CODES:
+                    source_row = {field_map[k]: v for k, v in record.items() if k in field_map}
+                    if source_row:
+                        redrive_spill.write(json.dumps(source_row) + "\n")
+                        redrive_headers.update(source_row.keys())
+                        redrive_count += 1
+        except Exception as e:
+            print(f"Failed to parse line in {key}: {e}")
+    return count, headers, redrive_count, redrive_headers
+
+
+def write_csv_from_spills(s3, bucket, key, headers, spill_paths):
+    upload = MultipartCsvUpload(s3, bucket, key)
+    try:
+        writer = csv.DictWriter(upload, fieldnames=headers)
+        writer.writeheader()
+        for path in spill_paths:
+            with open(path, encoding='utf-8') as spill:
+                for line in spill:
+                    writer.writerow(json.loads(line))
+        upload.complete()
+    except Exception:
+        upload.abort()
+        raise
+
+
+def checkForPartialFailure(execution_id, redrive_target=None):
+    """Rows are spilled to /tmp first because the CSV header (the union of all keys) is only known after every log is read."""
     s3 = boto3.client('s3')
     folder_prefix = 'phoenix-automation/error-logs//'+execution_id
     folder_prefix = folder_prefix+'/'
-    # List objects with the prefix
-    response = s3.list_objects_v2(
-        Bucket=S3_BUCKET,
-        Prefix=folder_prefix,
-        MaxKeys=1  # We only need to know if at least one object exists
-    )
+    # Every error object AppFlow wrote for this execution
+    paginator = s3.get_paginator('list_objects_v2')
+    keys = [
+        obj['Key']
+        for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=folder_prefix)
+        for obj in page.get('Contents', [])
+    ]
 
-    if 'Contents' in response:
-        content_key = response['Contents'][0]['Key']
-        response_for_file = s3.get_object(Bucket=S3_BUCKET, Key=content_key)
-        content = response_for_file['Body'].read().decode('utf-8')
-        print('content--', content)
-        failed_records = []
-        headers_set = set()
-
-        for line in content.strip().splitlines():
-            try:
-                item = json.loads(line)
-                # Loop inside errorDetails list
-                for err_detail in item.get('errorDetails', []):
-                    record_str = err_detail.get('record')
-                    error_str = err_detail.get('error')
+    if not keys:
+        return{
+            "statusCode": 200,
+            "num_rows": 0
+        }
 
-                    if not record_str or record_str == "null":
-                        continue
+    # Each log is parsed into its own spill file in /tmp, so memory stays flat
+    # and the header union is known before the CSV is written (see above)
+    with tempfile.TemporaryDirectory() as spill_dir:
+        spill_paths = [os.path.join(spill_dir, f"{i}.jsonl") for i in range(len(keys))]
+        redrive_paths = [os.path.join(spill_dir, f"{i}.redrive.jsonl") for i in range(len(keys))]
 
-                    record = json.loads(record_str)
-                    error_list = json.loads(error_str)  # list of error dicts
+        def parse(i):
+            with open(spill_paths[i], 'w', encoding='utf-8') as spill, \
+                 open(redrive_paths[i], 'w', encoding='utf-8') as redrive_spill:
+                if not redrive_target:
+                    return parse_error_log(s3, keys[i], spill)
+                return parse_error_log(s3, keys[i], spill, redrive_spill, redrive_target[2])
 
-                    for error_obj in error_list:
-                        combined = {**record, **error_obj}  # merge record + error into one dict
-                        failed_records.append(combined)
-                        headers_set.update(combined.keys())
-            except Exception as e:
-                print(f"Failed to parse line: {e}")
+        with ThreadPoolExecutor(max_workers=min(ERROR_LOG_WORKERS, len(keys))) as executor:
+            results = list(executor.map(parse, range(len(keys))))
 
-        num_failed = len(failed_records)
-        print(f"Number of failed records: {num_failed}")
+        num_failed = sum(r[0] for r in results)
+        print(f"Number of failed records: {num_failed} across {len(keys)} error logs")
 
         # Sort headers for consistency
-        headers = sorted(headers_set)
+        headers = sorted(set().union(*(r[1] for r in results)))
 
-        # Optionally: Convert to CSV in memory
-        output = io.StringIO()
-        writer = csv.DictWriter(output, fieldnames=headers)
-        writer.writeheader()
-        for record in failed_records:
-            writer.writerow(record)
-
-        csv_content = output.getvalue()
         file_name = f"failed_records_{execution_id}.csv"
+        write_csv_from_spills(s3, S3_BUCKET, f'phoenix-automation/error-logs/{file_name}', headers, spill_paths)
 
-        # Optional: Upload CSV to S3
-        s3.put_object(
-            Bucket=S3_BUCKET,
-            Key=f'phoenix-automation/error-logs/{file_name}',
-            Body=csv_content.encode('utf-8'),
-            ContentType='text/csv'
-        )
+        # Only the retryable records become the flow's next input
+        redrive_rows = sum(r[2] for r in results)
+        if redrive_rows:
+            bucket, key, field_map = redrive_target
+            # The flow's source columns, in mapping order
+            seen = set().union(*(r[3] for r in results))
+            redrive_headers = [c for c in dict.fromkeys(field_map.values()) if c in seen]
+            write_csv_from_spills(s3, bucket, key, redrive_headers, redrive_paths)
+            print(f"Wrote {redrive_rows} retryable records to s3://{bucket}/{key}")
 
-        return{
+    return{
+        "statusCode": 500,
+        "num_rows": num_failed,
+        "redrive_rows": redrive_rows
+    }
+
+def find_flow_execution(client, flow_name, execution_id, started_at=None):
+    """
+    Pages through the flow's run history (newest first) until execution_id turns up.
+    Stops once runs are older than started_at, since ours cannot be further back.
+    """
+    if execution_id in terminal_executions:
+        return terminal_executions[execution_id]
+
+    # Some slack for clock skew between our timestamp and AppFlow's
+    oldest = datetime.fromisoformat(started_at) - timedelta(minutes=5) if started_at else None
+    kwargs = {"flowName": flow_name, "maxResults": 100}
+    while True:
+        response = client.describe_flow_execution_records(**kwargs)
+        for record in response['flowExecutions']:
+            if not execution_id or record['executionId'] == execution_id:
+                if record['executionStatus'] not in ('InProgress', 'CancelStarted'):
+                    terminal_executions[record['executionId']] = record
+                return record
+            if oldest and record.get('startedAt') and record['startedAt'] < oldest:
+                return None
+        if not response.get('nextToken'):
+            return None
+        kwargs["nextToken"] = response['nextToken']
+
+
+def redrive_source(client, automation_name):
+    """
+    The single S3 object the flow reads, which a re-drive overwrites, plus the flow's
+    mapping from Salesforce field to source column; None when either is ambiguous.
+    """
+    flow = client.describe_flow(flowName=automation_name)
+    source = flow['sourceFlowConfig']['sourceConnectorProperties'].get('S3')
+    if not source:
+        return None
+    field_map = {
+        task['destinationField']: task['sourceFields'][0]
+        for task in flow.get('tasks', [])
+        if task.get('taskType') == 'Map' and task.get('destinationField') and len(task.get('sourceFields', [])) == 1
+    }
+    if not field_map:
+        print(f"Flow {automation_name} has no field mapping, not re-driving")
+        return None
+    s3 = boto3.client('s3')
+    response = s3.list_objects_v2(Bucket=source['bucketName'], Prefix=source.get('bucketPrefix', ''))
+    keys = [obj['Key'] for obj in response.get('Contents', []) if not obj['Key'].endswith('/')]
+    if len(keys) != 1:
+        print(f"Flow {automation_name} reads {len(keys)} objects, not re-driving")
+        return None
+    return source['bucketName'], keys[0], field_map
+
+
+def update_ledger(execution, record_id, total_records, passed_records, failed_records, status, stack_trace):
+    conn = get_db_connection()
+    prepare_ledger(conn)
+    cur = conn.cursor()
+    execute_ledger(cur, 'ledger_finish', (execution['lastUpdatedAt'], total_records, status, stack_trace, execution['executionId'], passed_records, failed_records, record_id))
+    conn.commit()
+    cur.close()
+
+
+def fold_redrive(res, execution, partial_failure):
+    """
+    Folds a finished execution (the original run or a re-drive) into the run's totals
+    and schedules another re-drive while retryable records remain and attempts are left.
+    """
+    processed = execution['executionResult']['recordsProcessed']
+    failed = partial_failure['num_rows']
+    retryable = partial_failure.get('redrive_rows', 0)
+    attempt = res.get("redrive_attempt", 0)
+
+    res["redrive_passed"] = res.get("redrive_passed", 0) + processed - failed
+    # Failures that will not be retried again are final
+    res["redrive_failed"] = res.get("redrive_failed", 0) + failed - retryable
+    passed, failed_total = res["redrive_passed"], res["redrive_failed"] + retryable
+    total = res["total_records"] if res.get("total_records") is not None else processed
+
+    if retryable:
+        res["redrive_attempt"] = attempt + 1
+        res["redrive_pending"] = True
+        # What the re-drive will send; next_poll_seconds sizes its waits from it
+        res["redrive_rows"] = retryable
+        delay = REDRIVE_BACKOFF_SECONDS * 2 ** attempt
+        res["redrive_not_before"] = (datetime.now().astimezone() + timedelta(seconds=delay)).isoformat()
+        update_ledger(execution, res["id"], total, passed, failed_total, 'REDRIVING',
+                      f"Re-driving {retryable} failed records, attempt {attempt + 1}")
+        return {
+            "statusCode": 200,
+            "execution_state": "InProgress",
+            "body": res
+        }
+
+    status = 'COMPLETED' if failed_total == 0 else ('FAILURE' if passed == 0 else 'PARTIAL_FAILURE')
+    stack_trace = f"Re-driven {attempt} time(s)" if failed_total == 0 else 'Failure at Appflow, please check the CSV'
+    update_ledger(execution, res["id"], total, passed, failed_total, status, stack_trace)
+    json_string = json.dumps([execution], default=default_serializer)
+    if failed_total:
+        return {
             "statusCode": 500,
-            "num_rows": num_failed
+            "successes": json_string,
+            "execution_state": "Failure"
         }
-    else:
-        return{
+    return {
+        "statusCode": 200,
+        "successes": json_string,
+        "execution_state": "Successful"
+    }
+
+
+def start_redrive(client, res):
+    """Starts the follow-up flow once its backoff has passed; the poll loop then tracks the new execution."""
+    if datetime.now().astimezone() < datetime.fromisoformat(res["redrive_not_before"]):
+        return {
             "statusCode": 200,
-            "num_rows": 0
+            "execution_state": "InProgress",
+            "body": res
+        }
+    res["started_at"] = datetime.now().astimezone().isoformat()
+    response = client.start_flow(flowName=res["automation_name"])
+    res["execution_id"] = response["executionId"]
+    res["redrive_pending"] = False
+    print(f"Re-drive attempt {res['redrive_attempt']} started as execution {res['execution_id']}")
+    return {
+        "statusCode": 200,
+        "execution_state": "InProgress",
+        "body": res
+    }
+
+
+def finish_bulk_load(body):
+    """Records a finished Bulk API 2.0 load in the ledger, mirroring a finished AppFlow run."""
+    result = body["bulk_result"]
+    processed = result["records_processed"]
+    failed = result["records_failed"]
+    passed = processed - failed
+    if not failed and not result["errors"]:
+        status = 'COMPLETED'
+    elif passed == 0:
+        status = 'FAILURE'
+    else:
+        status = 'PARTIAL_FAILURE'
+    stack_trace = 'Loaded through Salesforce Bulk API' if status == 'COMPLETED' else 'Failure at Bulk API, please check the CSV'
+    if result["errors"]:
+        stack_trace = f"{stack_trace}: {'; '.join(result['errors'])}"
+
+    update_ledger({'lastUpdatedAt': result["completed_at"], 'executionId': body["execution_id"]},
+                  body["id"], processed, passed, failed, status, stack_trace)
+    json_string = json.dumps([result], default=default_serializer)
+    if status != 'COMPLETED':
+        return {
+            "statusCode": 500,
+            "successes": json_string,
+            "execution_state": "Failure"
         }
+    return {
+        "statusCode": 200,
+        "successes": json_string,
+        "execution_state": "Successful"
+    }
+
+
+def automation_throughput(automation_name):
+    """Records per second over the automation's last 10 finished runs in the ledger, None without history."""
+    if automation_name in throughput_history:
+        return throughput_history[automation_name]
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT sum(total_records) / NULLIF(sum(extract(epoch FROM end_date - start_date)), 0)
+                FROM (
+                    SELECT total_records, start_date, end_date
+                    FROM {SCHEMA_NAME}.{TABLE_NAME}
+                    WHERE automation_name = %s
+                      AND status IN ('COMPLETED', 'PARTIAL_FAILURE')
+                      AND total_records > 0
+                      AND end_date > start_date
+                    ORDER BY start_date DESC
+                    LIMIT 10
+                ) recent
+            """, (automation_name,))
+            row = cur.fetchone()
+        conn.rollback()
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Could not read throughput history for {automation_name}: {e}")
+        return None
+    throughput_history[automation_name] = float(row[0]) if row and row[0] else None
+    return throughput_history[automation_name]
+
+
+def next_poll_seconds(body):
+    """
+    Wait before the next status poll: the time the run should still need at its
+    automation's usual throughput, clamped to MIN/MAX_POLL_SECONDS. Overdue runs
+    are polled at a tenth of their elapsed time.
+    """
+    now = datetime.now().astimezone()
+    if body.get("redrive_pending") and body.get("redrive_not_before"):
+        remaining = (datetime.fromisoformat(body["redrive_not_before"]) - now).total_seconds()
+        return int(min(max(remaining, MIN_POLL_SECONDS), MAX_POLL_SECONDS))
+
+    records = body.get("redrive_rows") if body.get("redrive_attempt") else body.get("total_records")
+    throughput = automation_throughput(body.get("automation_name"))
+    if not throughput or not records or not body.get("started_at"):
+        return DEFAULT_POLL_SECONDS
+
+    elapsed = (now - datetime.fromisoformat(body["started_at"])).total_seconds()
+    remaining = records / throughput - elapsed
+    if remaining <= 0:
+        remaining = elapsed / 10
+    return int(min(max(remaining, MIN_POLL_SECONDS), MAX_POLL_SECONDS))
+
 
 def lambda_handler(event, context):
+    result = check_run_status(event, context)
+    if result.get("execution_state") == "InProgress":
+        result["next_poll_seconds"] = next_poll_seconds(result.get("body", {}))
+    return result
+
+
+def check_run_status(event, context):
+    if event.get("body", {}).get("loader") == "bulk":
+        try:
+            return finish_bulk_load(event["body"])
+        except Exception as e:
+            return {
+                "statusCode": 500,
+                "error": str(e)
+            }
+
     # TODO implement
     res={}
     automation_name=event.get("body", {}).get("automation_name")
@@ -181,23 +603,29 @@ def lambda_handler(event, context):
     res["id"]=record_id
     total_records = event.get("body", {}).get("total_records")
     res["total_records"]=total_records
+    started_at = event.get("body", {}).get("started_at")
+    res["started_at"]=started_at
+    # Re-drive progress carried between polls
+    res.update({k: v for k, v in event.get("body", {}).items() if k.startswith("redrive_")})
 
     client = boto3.client('appflow')
     try:
-        response = client.describe_flow_execution_records(
-            flowName=automation_name,
-            maxResults=10  # optional
-        )
+        if res.get("redrive_pending"):
+            return start_redrive(client, res)
 
         # Filter by executionId if provided
         print("Looking for execution ID:", execution_id)
-        if execution_id:
-            matching_runs = [
-                record for record in response['flowExecutions']
-                if record['executionId'] == execution_id
-            ]
-        else:
-            matching_runs = response['flowExecutions']
+        execution = find_flow_execution(client, automation_name, execution_id, started_at)
+        if execution is None:
+            # A run that was just started may not be listed yet
+            if started_at and datetime.now().astimezone() - datetime.fromisoformat(started_at) < timedelta(seconds=EXECUTION_LOOKUP_GRACE_SECONDS):
+                return {
+                    "statusCode": 200,
+                    "execution_state": "InProgress",
+                    "body":res
+                }
+            raise ValueError(f"Execution {execution_id} not found in the run history of {automation_name}")
+        matching_runs = [execution]
 
         if matching_runs[0]['executionStatus']=='InProgress':
             return {
@@ -206,7 +634,12 @@ def lambda_handler(event, context):
                 "body":res
             }
         else:
-            partial_failure=checkForPartialFailure(execution_id)
+            redrive_target = None
+            if res.get("redrive_attempt", 0) < REDRIVE_MAX_ATTEMPTS:
+                redrive_target = redrive_source(client, automation_name)
+            partial_failure=checkForPartialFailure(execution_id, redrive_target)
+            if res.get("redrive_attempt") or partial_failure.get('redrive_rows'):
+                return fold_redrive(res, matching_runs[0], partial_failure)
             if partial_failure['statusCode']==500:
                 if total_records!=partial_failure:
                     failure_rows=total_records-partial_failure['num_rows']
@@ -232,4 +665,71 @@ def lambda_handler(event, context):
         return {
             "statusCode": 500,
             "error": str(e)
-        }
\ No newline at end of file
+        }
+
+
+def read_callback(s3, token_key):
+    try:
+        return json.loads(s3.get_object(Bucket=CALLBACK_BUCKET, Key=token_key)['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return None
+
+
+def claim_callback(s3, execution_id):
+    """
+    True for the single caller, the completion event or a late registration, that
+    finishes this run's wait. The claim is a conditional create, so only one succeeds.
+    """
+    try:
+        s3.put_object(Bucket=CALLBACK_BUCKET, Key=f"{CALLBACK_PREFIX}{execution_id}.claimed", Body=b"", IfNoneMatch='*')
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
+
+
+def appflow_event_handler(event, context):
+    """
+    Handles AppFlow's "AppFlow End Flow Run Report" EventBridge event. Finishes the run
+    exactly as a Step 3 poll would, then resumes the waiting execution with that result.
+    Example event detail: {"flow-name": "...", "execution-id": "...", "status": "Execution Successful"}
+    """
+    detail = event.get("detail", {})
+    execution_id = detail.get("execution-id")
+    if not execution_id:
+        print("Event has no execution-id, ignoring:", json.dumps(event, default=default_serializer))
+        return {"statusCode": 200, "resumed": False}
+
+    s3 = boto3.client('s3')
+    token_key = f"{CALLBACK_PREFIX}{execution_id}.json"
+    callback = read_callback(s3, token_key)
+    if callback is None:
+        # Not registered yet (or a run started outside the state machine); leave a
+        # marker so a late register_callback falls back to polling immediately
+        s3.put_object(Bucket=CALLBACK_BUCKET, Key=f"{CALLBACK_PREFIX}{execution_id}.completed", Body=b"")
+        # A registration that landed between the read and the marker did not see it
+        callback = read_callback(s3, token_key)
+        if callback is None:
+            print(f"No callback registered for execution {execution_id}")
+            return {"statusCode": 200, "resumed": False}
+
+    if not claim_callback(s3, execution_id):
+        # register_callback saw the marker and already sent the execution back to polling
+        print(f"Callback for execution {execution_id} already taken by its registration")
+        return {"statusCode": 200, "resumed": False}
+
+    # Same work as a Step 3 poll; an InProgress answer sends the execution back to polling
+    result = lambda_handler({"body": callback["body"]}, context)
+    sfn = boto3.client('stepfunctions')
+    try:
+        sfn.send_task_success(
+            taskToken=callback["task_token"],
+            output=json.dumps(result, default=default_serializer)
+        )
+    except (sfn.exceptions.TaskTimedOut, sfn.exceptions.TaskDoesNotExist, sfn.exceptions.InvalidToken) as e:
+        # The wait already timed out and the polling fallback owns this run
+        print(f"Execution for {execution_id} no longer waiting: {e}")
+    s3.delete_object(Bucket=CALLBACK_BUCKET, Key=token_key)
+    s3.delete_object(Bucket=CALLBACK_BUCKET, Key=f"{CALLBACK_PREFIX}{execution_id}.completed")
+    return {"statusCode": 200, "resumed": True, "result": result}
@@ -0,0 +1,206 @@
+"""
+Callback handshake between register_callback (appflow-connector) and
+appflow_event_handler (rds-connector), driven by a local stand-in for AppFlow's
+EventBridge event and in-memory S3 and Step Functions.
+"""
+import importlib.util
+import io
+import json
+import os
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("psycopg2")
+pytest.importorskip("jwt")
+from botocore.exceptions import ClientError  # noqa: E402
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+for name in ("SECRET_NAME", "SCHEMA_NAME", "TABLE_NAME", "S3_TARGET_BUCKET"):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("CALLBACK_BUCKET", "callbacks")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def load(filename, module_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+appflow = load("phoenix-automation-appflow-connector.py", "appflow_connector")
+rds = load("phoenix-automation-rds-connector.py", "rds_connector")
+
+EXECUTION_ID = "exec-0001"
+TOKEN_KEY = f"{rds.CALLBACK_PREFIX}{EXECUTION_ID}.json"
+COMPLETED_KEY = f"{rds.CALLBACK_PREFIX}{EXECUTION_ID}.completed"
+CLAIMED_KEY = f"{rds.CALLBACK_PREFIX}{EXECUTION_ID}.claimed"
+# The real Step 3 entry point, before the fixture replaces it
+check_run_status = rds.lambda_handler
+
+
+def flow_run_complete_event(execution_id=EXECUTION_ID, status="Execution Successful"):
+    """Local stand-in for AppFlow's "AppFlow End Flow Run Report" EventBridge event."""
+    return {
+        "version": "0",
+        "source": "aws.appflow",
+        "detail-type": "AppFlow End Flow Run Report",
+        "detail": {"flow-name": "asset-product-termination-updater", "execution-id": execution_id, "status": status},
+    }
+
+
+def client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class S3StandIn:
+    """Strongly consistent object store. `hooks[(operation, key)]` runs once, before that call."""
+
+    class exceptions:
+        ClientError = ClientError
+
+        class NoSuchKey(ClientError):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.hooks = {}
+
+    def _hook(self, operation, key):
+        hook = self.hooks.pop((operation, key), None)
+        if hook:
+            hook()
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, **kwargs):
+        self._hook("put", Key)
+        if IfNoneMatch == "*" and Key in self.objects:
+            raise client_error("PreconditionFailed", "PutObject")
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key):
+        self._hook("get", Key)
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey({"Error": {"Code": "NoSuchKey", "Message": Key}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def head_object(self, Bucket, Key):
+        self._hook("head", Key)
+        if Key not in self.objects:
+            raise client_error("404", "HeadObject")
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+
+class AppFlowStandIn:
+    def __init__(self, status):
+        self.status = status
+
+    def describe_flow_execution_records(self, flowName, maxResults, nextToken=None):
+        return {"flowExecutions": [{"executionId": EXECUTION_ID, "executionStatus": self.status}]}
+
+
+class StepFunctionsStandIn:
+    def __init__(self):
+        self.calls = []
+
+    def send_task_success(self, taskToken, output):
+        self.calls.append(("success", taskToken, json.loads(output)))
+
+    def send_task_failure(self, taskToken, error, cause):
+        self.calls.append(("failure", taskToken, error))
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    s3, sfn = S3StandIn(), StepFunctionsStandIn()
+    clients = {"s3": s3, "stepfunctions": sfn, "appflow": AppFlowStandIn("InProgress")}
+    for module in (appflow, rds):
+        monkeypatch.setattr(module, "CALLBACK_BUCKET", "callbacks")
+        monkeypatch.setattr(module.boto3, "client", lambda name, **kwargs: clients[name])
+    # These tests are about the handshake, so Step 3 just echoes the body;
+    # test_resumed_execution_gets_the_step_3_answer runs the real one
+    monkeypatch.setattr(rds, "lambda_handler", lambda event, context: {"statusCode": 200, "body": event["body"]})
+    return s3, sfn
+
+
+def register(token="token-1"):
+    return appflow.register_callback({"task_token": token, "body": {"execution_id": EXECUTION_ID}})
+
+
+def test_event_after_registration_resumes_the_execution(aws):
+    s3, sfn = aws
+    register()
+    result = rds.appflow_event_handler(flow_run_complete_event(), None)
+
+    assert result["resumed"] is True
+    assert sfn.calls == [("success", "token-1", {"statusCode": 200, "body": {"execution_id": EXECUTION_ID}})]
+    # Only the claim is left, for the prefix's lifecycle rule to expire
+    assert set(s3.objects) == {CLAIMED_KEY}
+
+
+def test_registration_after_event_falls_back_to_polling(aws):
+    s3, sfn = aws
+    assert rds.appflow_event_handler(flow_run_complete_event(), None)["resumed"] is False
+    assert COMPLETED_KEY in s3.objects
+    register()
+
+    assert sfn.calls == [("failure", "token-1", "FlowAlreadyCompleted")]
+    assert set(s3.objects) == {CLAIMED_KEY}
+
+
+def test_registration_between_token_read_and_marker_still_resumes(aws):
+    # The handler misses the token, the whole registration runs (and finds no
+    # marker yet), then the handler writes its marker
+    s3, sfn = aws
+    s3.hooks[("get", TOKEN_KEY)] = register
+    result = rds.appflow_event_handler(flow_run_complete_event(), None)
+
+    assert result["resumed"] is True
+    assert [call[0] for call in sfn.calls] == ["success"]
+    assert set(s3.objects) == {CLAIMED_KEY}
+
+
+def test_both_sides_seeing_each_other_finish_the_wait_once(aws):
+    # The token lands after the handler's first read and the registration's
+    # marker check runs after the handler wrote its marker: both try to finish
+    s3, sfn = aws
+    s3.hooks[("get", TOKEN_KEY)] = lambda: s3.put_object(
+        Bucket="callbacks", Key=TOKEN_KEY,
+        Body=json.dumps({"task_token": "token-1", "body": {"execution_id": EXECUTION_ID}}).encode()
+    )
+    handled = rds.appflow_event_handler(flow_run_complete_event(), None)
+    # The rest of that registration: its marker check now sees the marker
+    register()
+
+    assert handled["resumed"] is True
+    assert [call[0] for call in sfn.calls] == ["success"]
+
+
+def test_repeated_event_does_not_resume_twice(aws):
+    s3, sfn = aws
+    register()
+    rds.appflow_event_handler(flow_run_complete_event(), None)
+    rds.appflow_event_handler(flow_run_complete_event(), None)
+
+    assert len(sfn.calls) == 1
+
+
+def test_resumed_execution_gets_the_step_3_answer(aws, monkeypatch):
+    # The event can arrive before the run history lists the run as finished; the
+    # execution then gets Step 3's InProgress answer and goes back to polling
+    s3, sfn = aws
+    monkeypatch.setattr(rds, "lambda_handler", check_run_status)
+    monkeypatch.setattr(rds, "automation_throughput", lambda automation_name: None)
+    appflow.register_callback({"task_token": "token-1", "body": {
+        "execution_id": EXECUTION_ID, "automation_name": "asset-product-termination-updater", "id": 7, "total_records": 10
+    }})
+    rds.appflow_event_handler(flow_run_complete_event(), None)
+
+    [(outcome, token, output)] = sfn.calls
+    assert (outcome, token) == ("success", "token-1")
+    assert output["execution_state"] == "InProgress"
+    assert output["next_poll_seconds"] == rds.DEFAULT_POLL_SECONDS
+    assert output["body"]["execution_id"] == EXECUTION_ID
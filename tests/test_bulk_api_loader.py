@@ -0,0 +1,295 @@
+"""
+Bulk API 2.0 loader (appflow-connector) against a local http.server standing in
+for Salesforce's OAuth token and ingest job endpoints, with in-memory S3.
+"""
+import csv
+import importlib.util
+import io
+import json
+import os
+import re
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("jwt")
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("SECRET_NAME", "test")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+spec = importlib.util.spec_from_file_location(
+    "appflow_bulk_loader", os.path.join(ROOT, "phoenix-automation-appflow-connector.py")
+)
+appflow = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(appflow)
+
+AUTOMATION = "asset_product_termination_updater"
+SOURCE_KEY = "phoenix-automation/appflow-data/asset-product-termination-updater/contact_status.csv"
+JOB_PATH = re.compile(r"^/services/data/v\d+\.\d+/jobs/ingest/(?P<job>[^/]*)(?P<rest>/.*)?$")
+
+
+class SalesforceStandIn:
+    """
+    Ingest jobs keyed by id. A job reports InProgress for its first `polls_until_done`
+    status requests, then `final_state`; failed records are served as Salesforce does,
+    with sf__Id and sf__Error ahead of the record's fields.
+    """
+
+    def __init__(self, polls_until_done=0, final_state="JobComplete"):
+        self.polls_until_done = polls_until_done
+        self.final_state = final_state
+        self.jobs = {}
+        self.failed = {}
+        self.token_requests = []
+        self.lock = threading.Lock()
+
+    def handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, payload, content_type="application/json"):
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def authorised(self):
+                if self.headers.get("Authorization") != "Bearer session-token":
+                    self.reply(401, [{"errorCode": "INVALID_SESSION_ID"}])
+                    return False
+                return True
+
+            def do_POST(self):
+                if self.path == "/services/oauth2/token":
+                    stand_in.token_requests.append(self.body().decode())
+                    host, port = self.server.server_address
+                    return self.reply(200, {"access_token": "session-token", "instance_url": f"http://{host}:{port}/"})
+                match = JOB_PATH.match(self.path)
+                if not match or match["job"] or not self.authorised():
+                    return self.reply(404, {})
+                with stand_in.lock:
+                    job_id = f"750{len(stand_in.jobs):015d}"
+                    stand_in.jobs[job_id] = dict(json.loads(self.body()), id=job_id, state="Open", csv=None, polls=0)
+                self.reply(200, {"id": job_id, "state": "Open"})
+
+            def do_PUT(self):
+                match = JOB_PATH.match(self.path)
+                if not match or match["rest"] != "/batches" or not self.authorised():
+                    return self.reply(404, {})
+                assert self.headers["Content-Type"] == "text/csv"
+                stand_in.jobs[match["job"]]["csv"] = self.body().decode()
+                self.reply(201, b"", "text/plain")
+
+            def do_PATCH(self):
+                match = JOB_PATH.match(self.path)
+                if not match or match["rest"] or not self.authorised():
+                    return self.reply(404, {})
+                job = stand_in.jobs[match["job"]]
+                job["state"] = json.loads(self.body())["state"]
+                self.reply(200, {"id": job["id"], "state": job["state"]})
+
+            def do_GET(self):
+                match = JOB_PATH.match(self.path)
+                if not match or not self.authorised():
+                    return self.reply(404, {})
+                job = stand_in.jobs[match["job"]]
+                if match["rest"] == "/failedResults/":
+                    return self.reply(200, stand_in.failed.get(job["id"], "").encode(), "text/csv")
+                job["polls"] += 1
+                done = job["polls"] > stand_in.polls_until_done
+                rows = len(list(csv.reader(io.StringIO(job["csv"] or "")))[1:])
+                failed = len(list(csv.reader(io.StringIO(stand_in.failed.get(job["id"], ""))))[1:])
+                self.reply(200, {
+                    "id": job["id"],
+                    "state": stand_in.final_state if done else "InProgress",
+                    "numberRecordsProcessed": rows if done else 0,
+                    "numberRecordsFailed": failed if done else 0,
+                    "errorMessage": "InvalidBatch : field not writable" if done and stand_in.final_state == "Failed" else None,
+                })
+
+        return Handler
+
+
+class Body:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_lines(self, keepends=False):
+        return iter(self.data.splitlines(keepends=keepends))
+
+
+class S3StandIn:
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        return {"Body": Body(self.objects[Key])}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        self.objects[Key] = Fileobj.read()
+
+
+class Context:
+    """Lambda context whose remaining time shrinks by whatever the loader sleeps."""
+
+    def __init__(self, seconds):
+        self.remaining = seconds
+        self.sleeps = []
+
+    def get_remaining_time_in_millis(self):
+        return int(self.remaining * 1000)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.remaining -= seconds
+
+
+@pytest.fixture
+def salesforce(monkeypatch):
+    stand_in = SalesforceStandIn()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), stand_in.handler())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+
+    s3 = S3StandIn()
+    monkeypatch.setattr(appflow.boto3, "client", lambda name, **kwargs: {"s3": s3}[name])
+    monkeypatch.setattr(appflow, "LOGIN_URL", f"http://{host}:{port}/")
+    monkeypatch.setattr(appflow, "CLIENT_ID", "client")
+    monkeypatch.setattr(appflow, "generateToken", lambda: "signed-assertion")
+    monkeypatch.setattr(appflow, "bulk_access", None)
+    monkeypatch.setattr(appflow, "BULK_S3_BUCKET", "bucket")
+    monkeypatch.setattr(appflow, "BULK_API_AUTOMATIONS", {AUTOMATION: {"object": "Asset", "operation": "update", "source_key": SOURCE_KEY}})
+    yield stand_in, s3
+    server.shutdown()
+    server.server_close()
+
+
+def source_rows(count):
+    rows = [["Id", "Status", "Description"]]
+    for i in range(count):
+        # Every seventh description spans lines, as free text from the source often does
+        description = f"line one\nline two {i}" if i % 7 == 0 else f"plain {i}"
+        rows.append([f"02i{i:015d}", "Terminated", description])
+    return rows
+
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue()
+
+
+def start(count):
+    return appflow.lambda_handler({"body": {"automation_name": AUTOMATION, "id": 7, "total_records": count}}, None)
+
+
+def poll(body, context, monkeypatch):
+    monkeypatch.setattr(appflow, "time", types.SimpleNamespace(time=appflow.time.time, sleep=context.sleep))
+    return appflow.lambda_handler({"action": "bulk_status", "body": body}, context)
+
+
+def test_large_source_is_split_into_jobs_at_the_byte_limit(salesforce, monkeypatch):
+    stand_in, s3 = salesforce
+    monkeypatch.setattr(appflow, "BULK_JOB_MAX_BYTES", 400)
+    rows = source_rows(60)
+    s3.objects[SOURCE_KEY] = to_csv(rows).encode()
+
+    result = start(60)
+
+    job_ids = result["body"]["bulk_jobs"]
+    assert result["body"]["loader"] == "bulk"
+    assert len(job_ids) > 1
+    assert list(stand_in.jobs) == job_ids
+    assert len(stand_in.token_requests) == 1
+    uploaded = []
+    for position, job_id in enumerate(job_ids):
+        job = stand_in.jobs[job_id]
+        assert (job["object"], job["operation"], job["state"]) == ("Asset", "update", "UploadComplete")
+        parsed = list(csv.reader(io.StringIO(job["csv"])))
+        assert parsed[0] == rows[0]
+        # A job closes on the first row that takes it to the limit, never before
+        if position < len(job_ids) - 1:
+            assert len(job["csv"]) >= 400
+            assert len(to_csv(parsed[:-1])) < 400
+        uploaded.extend(parsed[1:])
+    assert uploaded == rows[1:]
+
+
+def test_status_backs_off_until_the_jobs_finish(salesforce, monkeypatch):
+    stand_in, s3 = salesforce
+    stand_in.polls_until_done = 6
+    s3.objects[SOURCE_KEY] = to_csv(source_rows(5)).encode()
+    body = start(5)["body"]
+
+    context = Context(seconds=900)
+    result = poll(body, context, monkeypatch)
+
+    assert result["execution_state"] == "Completed"
+    assert context.sleeps == [2, 4, 8, 16, 30, 30]
+    assert result["body"]["bulk_result"]["records_processed"] == 5
+    assert result["body"]["bulk_result"]["records_failed"] == 0
+    assert result["body"]["bulk_result"]["errors"] == []
+    # No failed records, no failures file
+    assert not any(key.startswith("phoenix-automation/error-logs/") for key in s3.objects)
+
+
+def test_status_returns_in_progress_before_the_invocation_runs_out(salesforce, monkeypatch):
+    stand_in, s3 = salesforce
+    stand_in.polls_until_done = 1000
+    s3.objects[SOURCE_KEY] = to_csv(source_rows(5)).encode()
+    body = start(5)["body"]
+
+    # 100 s left and a 30 s margin: 2 + 4 + 8 + 16 + 30 s of waiting fit, the next 30 s does not
+    context = Context(seconds=100)
+    result = poll(body, context, monkeypatch)
+
+    assert result["execution_state"] == "InProgress"
+    assert result["body"]["bulk_jobs"] == body["bulk_jobs"]
+    assert "bulk_result" not in result["body"]
+    assert context.sleeps == [2, 4, 8, 16, 30]
+    assert context.remaining >= appflow.BULK_POLL_MARGIN_SECONDS
+
+
+def test_failed_records_are_written_in_the_partial_failure_layout(salesforce, monkeypatch):
+    stand_in, s3 = salesforce
+    stand_in.final_state = "Failed"
+    monkeypatch.setattr(appflow, "BULK_JOB_MAX_BYTES", 150)
+    rows = source_rows(8)
+    s3.objects[SOURCE_KEY] = to_csv(rows).encode()
+    body = start(8)["body"]
+    first, second = body["bulk_jobs"][:2]
+    stand_in.failed[first] = to_csv([
+        ["sf__Id", "sf__Error", "Id", "Status", "Description"],
+        ["", "INVALID_CROSS_REFERENCE_KEY:invalid cross reference id", rows[1][0], "Terminated", rows[1][2]],
+    ])
+    stand_in.failed[second] = to_csv([
+        ["sf__Id", "sf__Error", "Id", "Status", "Description"],
+        ["", "FIELD_CUSTOM_VALIDATION_EXCEPTION:Status: cannot terminate", "02i999", "Terminated", "plain"],
+    ])
+
+    result = poll(body, Context(seconds=900), monkeypatch)
+
+    summary = result["body"]["bulk_result"]
+    assert summary["records_failed"] == 2
+    assert len(summary["errors"]) == len(body["bulk_jobs"])
+    assert summary["errors"][0] == f"{first}: InvalidBatch : field not writable"
+    written = s3.objects[f"phoenix-automation/error-logs/failed_records_{body['execution_id']}.csv"].decode()
+    failures = list(csv.reader(io.StringIO(written)))
+    assert failures[0] == ["Description", "Id", "Status", "message", "statusCode"]
+    assert failures[1:] == [
+        [rows[1][2], rows[1][0], "Terminated", "invalid cross reference id", "INVALID_CROSS_REFERENCE_KEY"],
+        ["plain", "02i999", "Terminated", "Status: cannot terminate", "FIELD_CUSTOM_VALIDATION_EXCEPTION"],
+    ]
@@ -0,0 +1,65 @@
+"""
+ChunkReader over iter_s3_ranges, whose part buffers are refilled as soon as the
+consumer asks for the next part.
+"""
+import io
+import os
+import sys
+import tarfile
+
+import pytest
+
+pytest.importorskip("paramiko")
+pytest.importorskip("boto3")
+pytest.importorskip("psycopg2")
+
+for name in ("DB_SECRET_NAME", "S3_BUCKET", "DB_SCHEMA", "DB_TABLE", "META_TABLE", "CONFIG_TABLE", "TRANSFER_LIMIT"):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("MAX_THREADS", "16")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dmf_filetransfer as dmf  # noqa: E402
+
+PART_SIZE = 1000
+
+
+class InstantS3:
+    """Answers ranged GETs from memory without any delay, so refills race the reader."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = (int(n) for n in Range[len("bytes="):].split("-"))
+        body = io.BytesIO(self.data[start:end + 1])
+        body.iter_chunks = lambda chunk_size: iter(lambda: body.read(chunk_size), b"")
+        return {"Body": body}
+
+
+@pytest.fixture
+def ranged(monkeypatch):
+    monkeypatch.setattr(dmf, "RANGE_PART_SIZE", PART_SIZE)
+    monkeypatch.setattr(dmf, "RANGE_READ_AHEAD", 2)
+    monkeypatch.setattr(dmf, "S3_READ_CHUNK_SIZE", 256)
+    data = os.urandom(PART_SIZE * 20 + 123)
+    return data, InstantS3(data)
+
+
+@pytest.mark.parametrize("read_size", [1500, 999, 1001, 4096])
+def test_reads_across_part_boundaries_return_the_object(ranged, read_size):
+    data, s3 = ranged
+    for _ in range(20):
+        reader = dmf.ChunkReader(dmf.iter_s3_ranges(s3, "key", len(data)))
+        out = b"".join(iter(lambda: reader.read(read_size), b""))
+        assert out == data
+
+
+def test_tar_member_matches_the_object(ranged):
+    data, s3 = ranged
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w|") as archive:
+        dmf.add_archive_member(archive, "file.pdf", len(data),
+                               dmf.ChunkReader(dmf.iter_s3_ranges(s3, "key", len(data))))
+    buffer.seek(0)
+    with tarfile.open(fileobj=buffer) as archive:
+        assert archive.extractfile("file.pdf").read() == data
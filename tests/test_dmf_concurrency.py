@@ -0,0 +1,161 @@
+"""
+Simulation of run_transfers' AIMD worker control against a throttled SFTP stand-in.
+
+Time is compressed: the injected clock runs SCALE times faster than the wall
+clock, and the stand-in sleeps each upload for its simulated duration / SCALE.
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("paramiko")
+pytest.importorskip("boto3")
+pytest.importorskip("psycopg2")
+
+for name in ("DB_SECRET_NAME", "S3_BUCKET", "DB_SCHEMA", "DB_TABLE", "META_TABLE", "CONFIG_TABLE", "TRANSFER_LIMIT"):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("MAX_THREADS", "16")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dmf_filetransfer as dmf  # noqa: E402
+
+SCALE = 50.0
+FILE_SIZE = 1024 * 1024
+
+
+class Session:
+    """SFTP session stand-in that drops after `files` uploads, like a server closing the connection."""
+
+    def __init__(self, files=None):
+        self.files_left = files
+        self.active = True
+
+    def use(self):
+        if self.files_left is not None:
+            if self.files_left == 0:
+                self.active = False
+                raise EOFError("Server connection dropped")
+            self.files_left -= 1
+
+    def get_channel(self):
+        return self
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return self.active
+
+
+class ThrottledSftpStandIn:
+    """
+    Stands in for both the SFTP pool and transfer_file. Each session uploads at
+    most `per_stream` bytes/s and all sessions share a link of `capacity` bytes/s. The first
+    `refuse_sessions` session requests fail like a refused SSH handshake.
+    """
+
+    def __init__(self, per_stream, capacity, refuse_sessions=0, first_session_files=None):
+        self.per_stream = per_stream
+        self.capacity = capacity
+        self.refuse_sessions = refuse_sessions
+        self.first_session_files = first_session_files
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.link_free_at = 0.0
+        self.session_requests = []  # simulated time of each session request
+
+    def clock(self):
+        return (time.monotonic() - self.started) * SCALE
+
+    # --- pool ---
+    def acquire(self):
+        with self.lock:
+            self.session_requests.append(self.clock())
+            if len(self.session_requests) <= self.refuse_sessions:
+                raise EOFError("SSH handshake refused")
+            first = len(self.session_requests) == self.refuse_sessions + 1
+        return Session(self.first_session_files if first else None)
+
+    def release(self, sftp):
+        pass
+
+    def close(self):
+        pass
+
+    # --- transfer_file ---
+    def transfer_file(self, s3_client, sftp, key, sftp_dir, objects, verify_remote=False):
+        sftp.use()
+        # The shared link carries one file per FILE_SIZE / capacity seconds, and
+        # no single session finishes faster than its own per-stream limit.
+        with self.lock:
+            now = self.clock()
+            self.link_free_at = max(now, self.link_free_at) + FILE_SIZE / self.capacity
+            finish = max(now + FILE_SIZE / self.per_stream, self.link_free_at)
+        time.sleep(max(0.0, finish - self.clock()) / SCALE)
+        return FILE_SIZE, "digest"
+
+
+@pytest.fixture
+def simulated(monkeypatch):
+    monkeypatch.setattr(dmf, "MIN_THREADS", 1)
+    monkeypatch.setattr(dmf, "MAX_THREADS", 16)
+    monkeypatch.setattr(dmf, "INITIAL_THREADS", 1)
+    monkeypatch.setattr(dmf, "CONCURRENCY_INTERVAL_SECONDS", 10.0)
+    monkeypatch.setattr(dmf, "CONCURRENCY_MIN_GAIN", 0.05)
+    monkeypatch.setattr(dmf, "SCHEDULER_TICK_SECONDS", 0.005)
+    monkeypatch.setattr(dmf, "telemetry", dmf.TransferTelemetry())
+
+    def run(stand_in, files):
+        monkeypatch.setattr(dmf, "transfer_file", stand_in.transfer_file)
+        peak = []
+        original_adjust = dmf.AdaptiveConcurrency.adjust
+
+        def adjust(controller):
+            target = original_adjust(controller)
+            peak.append(target)
+            return target
+
+        monkeypatch.setattr(dmf.AdaptiveConcurrency, "adjust", adjust)
+        keys = [f"prefix/file_{i:05d}.pdf" for i in range(files)]
+        digests = {}
+        transferred, failed = dmf.run_transfers(
+            None, iter(keys), "/dmf", {}, digests, pool=stand_in, clock=stand_in.clock
+        )
+        return transferred, failed, peak
+
+    return run
+
+
+def test_workers_grow_until_the_server_saturates(simulated):
+    # 1 MB/s per session, 4 MB/s in total: more than ~4 workers gains nothing
+    stand_in = ThrottledSftpStandIn(per_stream=1024 * 1024, capacity=4 * 1024 * 1024)
+    transferred, failed, targets = simulated(stand_in, files=1000)
+
+    assert len(transferred) == 1000
+    assert failed == []
+    assert 4 <= max(targets) <= 6
+
+
+def test_refused_handshakes_back_off_per_slot(simulated, monkeypatch):
+    monkeypatch.setattr(dmf, "SFTP_HANDSHAKE_BACKOFF_SECONDS", 2.0)
+    stand_in = ThrottledSftpStandIn(per_stream=1024 * 1024, capacity=4 * 1024 * 1024, refuse_sessions=3)
+    transferred, failed, _ = simulated(stand_in, files=200)
+
+    assert len(transferred) == 200
+    assert failed == []
+    # The slot waits 2, 4, then 8 simulated seconds before asking for a new session
+    gaps = [b - a for a, b in zip(stand_in.session_requests, stand_in.session_requests[1:4])]
+    for gap, backoff in zip(gaps, (2.0, 4.0, 8.0)):
+        assert gap >= backoff
+
+
+def test_dropped_session_requeues_its_file_and_reconnects(simulated):
+    stand_in = ThrottledSftpStandIn(per_stream=1024 * 1024, capacity=4 * 1024 * 1024, first_session_files=2)
+    transferred, failed, _ = simulated(stand_in, files=400)
+
+    assert sorted(transferred) == sorted(f"file_{i:05d}.pdf" for i in range(400))
+    assert failed == []
+    assert len(stand_in.session_requests) >= 2